@@ -9,7 +9,12 @@
 #
 # October, 2014
 
-import requests
+import json, mmap, struct, heapq
+from array import array
+from bisect import bisect_left
+from itertools import islice, izip, repeat
+from collections import Counter
+from threading import Lock
 
 from BaseImport import *
 from soqlinterface import *
@@ -22,6 +27,50 @@ from soqlinterface import *
 # self.flag => Flag to Check whether the node is an end character of a valid string
 # self.left, self.right => Links to the next nodes ( Working similar to Binary Search Tree)
 # self.center => Link to the next valid character
+# self.value => The display (correct case) value of a valid string, set on
+#               the node holding its end character
+# self.mask => Bitmask of the fields (see Fields) the string belongs to.
+#              flag is set whenever mask is not 0
+# self.fieldWeights => The popularity of the string in each of those fields
+# self.maxWeight => The highest weight of any string ending in this node's
+#                   subtree (left, right and center). Lets the weighted
+#                   search skip whole subtrees
+
+
+# One step of the Levenshtein distance table: given the distances from a
+# string to every prefix of query (row), returns the distances from that
+# string plus ch to every prefix of query
+def editDistanceRow(row, query, ch) :
+  newrow = [row[0] + 1]
+  for j in range(1, len(row)) :
+    newrow.append(min(row[j] + 1,
+                      newrow[j-1] + 1,
+                      row[j-1] + (query[j-1] != ch)))
+  return newrow
+
+
+#
+# The fields a suggestion can come from. All of them share one autocomplete
+# index, where every string carries a bitmask (1 << field) of the fields it
+# belongs to, as the same string can be, say, both an actor and a director.
+#
+# names => the field's name in doAutocomplete results
+# commands => the MainPage search command to run when a suggestion is picked
+# columns => the SFMovie database columns holding the field's values
+#
+class Fields :
+  title    = 0
+  location = 1
+  actor    = 2
+  director = 3
+  count    = 4
+  names    = ('title', 'locations', 'actor', 'director')
+  commands = ('ts', 'ls', 'as', 'ds')
+  columns  = (('title',), ('locations',), ('actor_1', 'actor_2', 'actor_3'), ('director',))
+
+# The fields in each possible mask, lowest first
+Fields.inMask = tuple(tuple(field for field in range(Fields.count) if mask & (1 << field))
+                      for mask in range(1 << Fields.count))
 
 
 # Ternary tree node. This implementation does not have a special class
@@ -34,26 +83,50 @@ class Node:
     self.left = 0
     self.right = 0
     self.center = 0
+    self.value = None
+    self.mask = 0
+    self.fieldWeights = None
+    self.maxWeight = 0
 
-  def addString(self,string) :
+  # Value is what getCompletions hands back for this string. If not given,
+  # the string itself is used. Field (see Fields) says what the string is,
+  # weight is its popularity as such. A string can be added in several fields
+  def addString(self,string,value=None,field=0,weight=0) :
     # Prevent needless generation of strings
     if (ISLEVEL(1)) : INFOPRINT("ADDDING STRING \"%s\""%string,1)
-    self.add(string,self)
+    self.add(string,self,string if value is None else value,field,weight)
 
-  def add(self,string,node): # Function to add a string
+  def add(self,string,node,value=None,field=0,weight=0): # Function to add a string
     key = string[0]
     if node == 0 :
         node = Node(key,0)
+    if node.maxWeight < weight :
+        node.maxWeight = weight
     if key < node.ch :
-        node.left = node.add(string,node.left)
+        node.left = node.add(string,node.left,value,field,weight)
     elif key > node.ch :
-        node.right = node.add(string,node.right)
+        node.right = node.add(string,node.right,value,field,weight)
     else :
         if len(string) == 1 :
             node.flag = 1
-        else : node.center = node.add(string[1:],node.center)
+            node.value = value
+            node.mask |= (1 << field)
+            if node.fieldWeights is None :
+                node.fieldWeights = [0] * Fields.count
+            node.fieldWeights[field] = weight
+        else : node.center = node.add(string[1:],node.center,value,field,weight)
     return node
 
+  # Takes string out of field. Once it is in no field at all, the string
+  # is no longer in the tree, although its nodes are left in place
+  def removeString(self,string,field=0):
+    node = self.findNode(string)
+    if (node != 0 and node.flag == 1) :
+      node.mask &= ~(1 << field)
+      node.fieldWeights[field] = 0
+      if (node.mask == 0) :
+        node.flag = 0
+
   def spdfs(self,match,setHolder):  # DFS for Ternary Search Tree
     if self.flag == 1 :
       setHolder.setObj.add(match)
@@ -124,90 +197,1386 @@ class Node:
     self.autocomplete(string,'',setHolder)
     return setHolder.setObj
 
+  # Returns the node holding the last character of string, or 0
+  def findNode(self,string):
+    temp = self
+    i=0
+    while temp != 0 and len(string) > 0 :
+      if (string[i] < temp.ch) :  temp = temp.left
+      elif(string[i] > temp.ch) : temp = temp.right
+      else :
+        i=i+1
+        if(i == len(string)):
+          return temp
+        temp = temp.center
+    return 0
+
+  # Takes a string to autocomplete against, returns a list of the
+  # (value, field) entries of the matches, already in sorted order. Stops
+  # walking the tree after limit entries (None means no limit)
+  def getCompletions(self,string,limit=None):
+    retval = list()
+    node = self.findNode(string)
+    if (node == 0) :
+      return retval
+    return Node.subtreeEntries(node, retval, limit)
+
+  # Appends to retval the entries of node (if it ends a string) and then
+  # the entries of all the strings that continue on from node, in sorted
+  # order, until retval holds limit entries
+  @staticmethod
+  def subtreeEntries(node, retval, limit=None):
+    if (node.flag == 1) :
+      retval.extend((node.value, field) for field in Fields.inMask[node.mask])
+    # In-order walk: left, the node itself, center, right.
+    # A (node, True) entry on the stack means "emit this node"
+    stack = list()
+    if (node.center != 0) :
+      stack.append((node.center, False))
+    while stack and (limit is None or len(retval) < limit) :
+      node, emit = stack.pop()
+      if (emit) :
+        retval.extend((node.value, field) for field in Fields.inMask[node.mask])
+        continue
+      if (node.right != 0) :  stack.append((node.right, False))
+      if (node.center != 0) : stack.append((node.center, False))
+      if (node.flag == 1) :   stack.append((node, True))
+      if (node.left != 0) :   stack.append((node.left, False))
+    return retval[:limit] if limit is not None else retval
+
+  # Pushes a match for each field of the string ending at node
+  @staticmethod
+  def pushMatches(heap, node):
+    lower = node.value.lower()
+    for field in Fields.inMask[node.mask] :
+      heapq.heappush(heap, (-node.fieldWeights[field], 1, lower, field, node.value))
+
+  # Takes a string to autocomplete against, returns a list of the
+  # (value, field) entries of the limit (None means all) heaviest matches,
+  # heaviest first, ties in sorted order.
+  # Best first search: the heap holds subtrees, keyed on their maxWeight,
+  # and matches, keyed on their weight. A match popped off the heap is
+  # heavier than anything still unexplored, so we stop after limit of them
+  def getTopCompletions(self,string,limit=None):
+    retval = list()
+    node = self.findNode(string)
+    if (node == 0) :
+      return retval
+    # (-weight, 0, node) is a subtree, (-weight, 1, sort key, field, value)
+    # a match. On ties subtrees come first, so that an equally heavy match
+    # inside them gets its chance to sort ahead
+    heap = list()
+    if (node.flag == 1) :
+      Node.pushMatches(heap, node)
+    if (node.center != 0) :
+      heapq.heappush(heap, (-node.center.maxWeight, 0, node.center))
+    while heap and (limit is None or len(retval) < limit) :
+      entry = heapq.heappop(heap)
+      if (entry[1] == 1) :
+        retval.append((entry[4], entry[3]))
+        continue
+      node = entry[2]
+      if (node.flag == 1) :
+        Node.pushMatches(heap, node)
+      for child in (node.left, node.center, node.right) :
+        if (child != 0) :
+          heapq.heappush(heap, (-child.maxWeight, 0, child))
+    return retval
+
+  # Typo tolerant autocomplete. Returns a dict of (value, field) entry to
+  # edit distance for every string having a prefix within maxdist edits of
+  # string. The distance is that of the string's closest prefix.
+  # Each stack entry carries the edit distance row of the string matched
+  # down to (but not including) the node, and the best distance of any
+  # prefix along the way. Once no longer prefix can do better (the row
+  # never goes down), the whole subtree gets that best distance; a branch
+  # is dropped as soon as that is over budget
+  def getFuzzyCompletions(self,string,maxdist):
+    retval = dict()
+    stack = list()
+    if (self.right != 0) :
+      stack.append((self.right, range(len(string)+1), len(string)))
+    while stack :
+      node, row, best = stack.pop()
+      if (node.left != 0) :  stack.append((node.left, row, best))
+      if (node.right != 0) : stack.append((node.right, row, best))
+      newrow = editDistanceRow(row, string, node.ch)
+      nodebest = min(best, newrow[-1])
+      lowest = min(newrow)
+      if (lowest >= nodebest) :
+        if (nodebest <= maxdist) :
+          # Everything from here on down matches, and none any better
+          for entry in Node.subtreeEntries(node, list()) :
+            retval[entry] = nodebest
+        continue
+      if (lowest > maxdist) :
+        continue
+      if (node.flag == 1 and nodebest <= maxdist) :
+        for field in Fields.inMask[node.mask] :
+          retval[(node.value, field)] = nodebest
+      if (node.center != 0) :
+        stack.append((node.center, newrow, nodebest))
+    return retval
+
+
+#
+# Compact ternary tree. Answers the same queries as Node, but instead of
+# one Python object per character, the whole tree lives in a handful of
+# parallel flat arrays indexed by node number:
+#
+# self.chars => ordinal of the node's character
+# self.left, self.right, self.center => index of the child node, 0 if none
+# self.flags => bitmap, one bit per node, set if the node ends a valid string
+# self.valueIds => index into self.valueTable of the node's display value
+# self.maxWeights => the highest weight (popularity) of any string ending in
+#                    the node's subtree (left, right and center)
+# self.valueMasks => the bitmask of fields (see Fields) of each entry in
+#                    self.valueTable
+# self.fieldWeights => the weight of each entry in self.valueTable in each
+#                      field, Fields.count weights per entry
+#
+# Node 0 is a dummy that is never linked to, so that 0 can mean "no node"
+# just as it does in Node. Insert and search are iterative, so long location
+# strings do not recurse.
+#
+class CompactTernaryTree :
+  def __init__(self) :
+    self.chars  = array('i', [0])
+    self.left   = array('i', [0])
+    self.right  = array('i', [0])
+    self.center = array('i', [0])
+    self.flags  = bytearray(1)
+    self.valueIds = array('i', [-1])
+    self.maxWeights = array('i', [0])
+    self.valueTable = list()
+    self.valueMasks = array('i')
+    self.fieldWeights = array('i')
+    self.root   = 0
+
+  def newNode(self, ch) :
+    index = len(self.chars)
+    self.chars.append(ch)
+    self.left.append(0)
+    self.right.append(0)
+    self.center.append(0)
+    self.valueIds.append(-1)
+    self.maxWeights.append(0)
+    if ((index >> 3) >= len(self.flags)) :
+      self.flags.append(0)
+    return index
+
+  def isTerminal(self, index) :
+    return (self.flags[index >> 3] >> (index & 7)) & 1
+
+  def setTerminal(self, index) :
+    self.flags[index >> 3] |= (1 << (index & 7))
+
+  def clearTerminal(self, index) :
+    self.flags[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+  # Takes string out of field. Once it is in no field at all, the string
+  # is removed from the tree. The nodes are left in place (they may be
+  # shared with other strings), the string just no longer ends there
+  def removeString(self, string, field=0) :
+    node = self.findNode(string)
+    if (node == 0 or not self.isTerminal(node)) :
+      return
+    valueId = self.valueIds[node]
+    self.valueMasks[valueId] &= ~(1 << field)
+    self.fieldWeights[valueId * Fields.count + field] = 0
+    if (self.valueMasks[valueId] == 0) :
+      self.clearTerminal(node)
+
+  # Returns an independent copy of the tree. Only the arrays are copied,
+  # there are no per-node objects to duplicate
+  def copy(self) :
+    tree = CompactTernaryTree()
+    tree.chars    = array('i', self.chars)
+    tree.left     = array('i', self.left)
+    tree.right    = array('i', self.right)
+    tree.center   = array('i', self.center)
+    tree.flags    = bytearray(self.flags)
+    tree.valueIds = array('i', self.valueIds)
+    tree.maxWeights = array('i', self.maxWeights)
+    tree.valueTable = list(self.valueTable)
+    tree.valueMasks = array('i', self.valueMasks)
+    tree.fieldWeights = array('i', self.fieldWeights)
+    tree.root     = self.root
+    return tree
+
+  def nodeCount(self) :
+    return len(self.chars) - 1
+
+  # Approximate size of the tree in bytes (array buffers only)
+  def sizeInBytes(self) :
+    return (self.chars.itemsize * len(self.chars) +
+            self.left.itemsize * len(self.left) +
+            self.right.itemsize * len(self.right) +
+            self.center.itemsize * len(self.center) +
+            self.valueIds.itemsize * len(self.valueIds) +
+            self.maxWeights.itemsize * len(self.maxWeights) +
+            self.valueMasks.itemsize * len(self.valueMasks) +
+            self.fieldWeights.itemsize * len(self.fieldWeights) +
+            len(self.flags))
+
+  # The tree's arrays, by name, for writing out to a snapshot
+  def snapshotArrays(self) :
+    return { 'chars'    : self.chars,
+             'left'     : self.left,
+             'right'    : self.right,
+             'center'   : self.center,
+             'flags'    : array('B', self.flags),
+             'valueIds' : self.valueIds,
+             'maxWeights'   : self.maxWeights,
+             'valueMasks'   : self.valueMasks,
+             'fieldWeights' : self.fieldWeights }
+
+  # Rebuilds a tree from the output of snapshotArrays. No per-node
+  # work is done: the arrays are used as is
+  @staticmethod
+  def fromSnapshot(root, arrays, valueTable) :
+    tree = CompactTernaryTree()
+    tree.chars    = arrays['chars']
+    tree.left     = arrays['left']
+    tree.right    = arrays['right']
+    tree.center   = arrays['center']
+    tree.flags    = bytearray(arrays['flags'].tostring())
+    tree.valueIds = arrays['valueIds']
+    tree.maxWeights = arrays['maxWeights']
+    tree.valueTable = valueTable
+    tree.valueMasks = arrays['valueMasks']
+    tree.fieldWeights = arrays['fieldWeights']
+    tree.root     = root
+    return tree
+
+  def setValue(self, index, value, field=0, weight=0) :
+    valueId = self.valueIds[index]
+    if (valueId < 0) :
+      valueId = self.valueIds[index] = len(self.valueTable)
+      self.valueTable.append(value)
+      self.valueMasks.append(0)
+      self.fieldWeights.extend(repeat(0, Fields.count))
+    else :
+      self.valueTable[valueId] = value
+    self.valueMasks[valueId] |= (1 << field)
+    self.fieldWeights[valueId * Fields.count + field] = weight
+
+  # The (value, field) entries of the string ending at node
+  def entries(self, node) :
+    valueId = self.valueIds[node]
+    value = self.valueTable[valueId]
+    return [(value, field) for field in Fields.inMask[self.valueMasks[valueId]]]
+
+  # Value is what getCompletions hands back for this string. If not given,
+  # the string itself is used. Field (see Fields) says what the string is,
+  # weight is its popularity as such. A string can be added in several fields.
+  # Adding a string that is already there in field updates its value and weight
+  def addString(self, string, value=None, field=0, weight=0) :
+    if (not string) :
+      return
+    # Prevent needless generation of strings
+    if (ISLEVEL(1)) : INFOPRINT("ADDDING STRING \"%s\""%string,1)
+    chars = self.chars
+    left = self.left
+    right = self.right
+    center = self.center
+    maxWeights = self.maxWeights
+    if (self.root == 0) :
+      self.root = self.newNode(ord(string[0]))
+    node = self.root
+    i = 0
+    last = len(string) - 1
+    key = ord(string[0])
+    while True :
+      # Every node on the way down has this string in its subtree
+      if (maxWeights[node] < weight) :
+        maxWeights[node] = weight
+      ch = chars[node]
+      if (key < ch) :
+        nextnode = left[node]
+        if (nextnode == 0) :
+          nextnode = self.newNode(key)
+          left[node] = nextnode
+      elif (key > ch) :
+        nextnode = right[node]
+        if (nextnode == 0) :
+          nextnode = self.newNode(key)
+          right[node] = nextnode
+      else :
+        if (i == last) :
+          self.setTerminal(node)
+          self.setValue(node, string if value is None else value, field, weight)
+          return
+        i += 1
+        key = ord(string[i])
+        nextnode = center[node]
+        if (nextnode == 0) :
+          nextnode = self.newNode(key)
+          center[node] = nextnode
+      node = nextnode
+
+  # Returns the index of the node holding the last character of string,
+  # or 0 if string is not a prefix of anything in the tree
+  def findNode(self, string) :
+    if (not string) :
+      return 0
+    chars = self.chars
+    node = self.root
+    i = 0
+    last = len(string) - 1
+    key = ord(string[0])
+    while node != 0 :
+      ch = chars[node]
+      if (key < ch) :    node = self.left[node]
+      elif (key > ch) :  node = self.right[node]
+      else :
+        if (i == last) :
+          return node
+        i += 1
+        key = ord(string[i])
+        node = self.center[node]
+    return 0
+
+  # Function to search a string in the tree
+  # returns 1 if found, 0 otherwise
+  def findString(self, string) :
+    node = self.findNode(string)
+    if (node == 0) :
+      return 0
+    return self.isTerminal(node)
+
+  # Takes a string to autocomplete against, returns a
+  # set of matches
+  def getAutocomplete(self, string) :
+    matches = set()
+    node = self.findNode(string)
+    if (node == 0) :
+      return matches
+    if (self.isTerminal(node)) :
+      matches.add(string)
+    chars = self.chars
+    left = self.left
+    right = self.right
+    center = self.center
+    # Explicit stack of (node, string matched so far, NOT including the node)
+    stack = list()
+    if (center[node] != 0) :
+      stack.append((center[node], string))
+    while stack :
+      node, match = stack.pop()
+      here = match + unichr(chars[node])
+      if (self.isTerminal(node)) :
+        matches.add(here)
+      if (left[node] != 0) :
+        stack.append((left[node], match))
+      if (right[node] != 0) :
+        stack.append((right[node], match))
+      if (center[node] != 0) :
+        stack.append((center[node], here))
+    return matches
+
+  # Takes a string to autocomplete against, returns a list of the
+  # (value, field) entries of the matches, already in sorted order. Stops
+  # walking the tree after limit entries (None means no limit)
+  def getCompletions(self, string, limit=None) :
+    retval = list()
+    node = self.findNode(string)
+    if (node == 0) :
+      return retval
+    return self.subtreeEntries(node, retval, limit)
+
+  # Appends to retval the entries of node (if it ends a string) and then
+  # the entries of all the strings that continue on from node, in sorted
+  # order, until retval holds limit entries
+  def subtreeEntries(self, node, retval, limit=None) :
+    left = self.left
+    right = self.right
+    center = self.center
+    if (self.isTerminal(node)) :
+      retval.extend(self.entries(node))
+    # In-order walk: left, the node itself, center, right.
+    # A negative entry on the stack means "emit node -entry"
+    stack = list()
+    if (center[node] != 0) :
+      stack.append(center[node])
+    while stack and (limit is None or len(retval) < limit) :
+      node = stack.pop()
+      if (node < 0) :
+        retval.extend(self.entries(-node))
+        continue
+      if (right[node] != 0) :   stack.append(right[node])
+      if (center[node] != 0) :  stack.append(center[node])
+      if (self.isTerminal(node)) : stack.append(-node)
+      if (left[node] != 0) :    stack.append(left[node])
+    return retval[:limit] if limit is not None else retval
+
+  # Pushes a match for each field of the string ending at node
+  def pushMatches(self, heap, node) :
+    valueId = self.valueIds[node]
+    value = self.valueTable[valueId]
+    lower = value.lower()
+    base = valueId * Fields.count
+    for field in Fields.inMask[self.valueMasks[valueId]] :
+      heapq.heappush(heap, (-self.fieldWeights[base + field], 1, lower, field, value))
+
+  # Takes a string to autocomplete against, returns a list of the
+  # (value, field) entries of the limit (None means all) heaviest matches,
+  # heaviest first, ties in sorted order.
+  # Best first search: the heap holds subtrees, keyed on their maxWeight,
+  # and matches, keyed on their weight. A match popped off the heap is
+  # heavier than anything still unexplored, so we stop after limit of them.
+  # Removed strings may leave maxWeights too high, which costs a little
+  # extra searching but never a wrong answer
+  def getTopCompletions(self, string, limit=None) :
+    retval = list()
+    node = self.findNode(string)
+    if (node == 0) :
+      return retval
+    left = self.left
+    right = self.right
+    center = self.center
+    maxWeights = self.maxWeights
+    # (-weight, 0, node) is a subtree, (-weight, 1, sort key, field, value)
+    # a match. On ties subtrees come first, so that an equally heavy match
+    # inside them gets its chance to sort ahead
+    heap = list()
+    if (self.isTerminal(node)) :
+      self.pushMatches(heap, node)
+    if (center[node] != 0) :
+      heapq.heappush(heap, (-maxWeights[center[node]], 0, center[node]))
+    while heap and (limit is None or len(retval) < limit) :
+      entry = heapq.heappop(heap)
+      if (entry[1] == 1) :
+        retval.append((entry[4], entry[3]))
+        continue
+      node = entry[2]
+      if (self.isTerminal(node)) :
+        self.pushMatches(heap, node)
+      for child in (left[node], center[node], right[node]) :
+        if (child != 0) :
+          heapq.heappush(heap, (-maxWeights[child], 0, child))
+    return retval
+
+  # Typo tolerant autocomplete. Returns a dict of (value, field) entry to
+  # edit distance for every string having a prefix within maxdist edits of
+  # string. The distance is that of the string's closest prefix.
+  # Walks the tree the same way Node.getFuzzyCompletions does
+  def getFuzzyCompletions(self, string, maxdist) :
+    retval = dict()
+    if (self.root == 0) :
+      return retval
+    query = [ord(ch) for ch in string]
+    chars = self.chars
+    left = self.left
+    right = self.right
+    center = self.center
+    stack = [(self.root, range(len(query)+1), len(query))]
+    while stack :
+      node, row, best = stack.pop()
+      if (left[node] != 0) :  stack.append((left[node], row, best))
+      if (right[node] != 0) : stack.append((right[node], row, best))
+      newrow = editDistanceRow(row, query, chars[node])
+      nodebest = min(best, newrow[-1])
+      lowest = min(newrow)
+      if (lowest >= nodebest) :
+        if (nodebest <= maxdist) :
+          # Everything from here on down matches, and none any better
+          for entry in self.subtreeEntries(node, list()) :
+            retval[entry] = nodebest
+        continue
+      if (lowest > maxdist) :
+        continue
+      if (self.isTerminal(node) and nodebest <= maxdist) :
+        for entry in self.entries(node) :
+          retval[entry] = nodebest
+      if (center[node] != 0) :
+        stack.append((center[node], newrow, nodebest))
+    return retval
+
+
+#
+# Inverted index of word starts, so that "Franklin" finds
+# "2417 Franklin Street" and "Bridge" finds "Golden Gate Bridge".
+# Like the ternary tree, it covers every field at once: what it indexes
+# are (value, field) entries.
+#
+# self.values, self.fields => the display value and field (see Fields) of
+#                each entry, heaviest (most popular) first, ties sorted
+#                case-insensitively, then by field. An entry's position in
+#                these lists is its id
+# self.postingData => all the posting lists, end to end, in one flat array
+# self.postings => every prefix of every word in the values, mapped to the
+#                  (start, end) slice of postingData holding the ascending
+#                  ids of the entries having such a word
+#
+# Since ids are handed out in that order, walking a posting list yields
+# entries already in popularity order, and the top few are found without
+# looking at the rest.
+#
+class TokenIndex :
+  wordRegexp = re.compile(r"\w+", re.UNICODE)
+
+  # weights maps a (value, field) entry to its weight (popularity), if
+  # there is one
+  def __init__(self, entries=(), weights={}) :
+    entries = sorted(set(entries),
+                     key=lambda entry: (-weights.get(entry, 0), entry[0].lower(), entry[1]))
+    self.values = [value for value, field in entries]
+    self.fields = array('i', [field for value, field in entries])
+    lists = dict()
+    for entryId, value in enumerate(self.values) :
+      for word in TokenIndex.words(value) :
+        for length in range(1, len(word)+1) :
+          posting = lists.get(word[:length])
+          if (posting is None) :
+            posting = lists[word[:length]] = array('i')
+          # The same prefix can occur in several words of one value
+          if (not posting or posting[-1] != entryId) :
+            posting.append(entryId)
+    self.postingData = array('i')
+    self.postings = dict()
+    for prefix, posting in lists.items() :
+      start = len(self.postingData)
+      self.postingData.extend(posting)
+      self.postings[prefix] = (start, len(self.postingData))
+
+  @staticmethod
+  def words(string) :
+    return TokenIndex.wordRegexp.findall(string.lower())
+
+  # Generates the (value, field) entries having, for every word in string,
+  # a word starting with it, heaviest first. Entries in exclude are skipped
+  def matches(self, string, exclude=()) :
+    postings = list()
+    for word in TokenIndex.words(string) :
+      posting = self.postings.get(word)
+      if (posting is None) :
+        return
+      postings.append(posting)
+    if (not postings) :
+      return
+    # Walk the shortest posting list, and binary search the others
+    postings.sort(key=lambda posting: posting[1] - posting[0])
+    data = self.postingData
+    start, end = postings[0]
+    others = postings[1:]
+    for k in xrange(start, end) :
+      entryId = data[k]
+      found = True
+      for lo, hi in others :
+        i = bisect_left(data, entryId, lo, hi)
+        if (i == hi or data[i] != entryId) :
+          found = False
+          break
+      if (found) :
+        entry = (self.values[entryId], self.fields[entryId])
+        if (entry not in exclude) :
+          yield entry
+
+  # Returns the limit (None means all) heaviest matches for string,
+  # heaviest first, ties in sorted order. Stops after limit entries
+  def findTop(self, string, limit=None, exclude=()) :
+    return list(islice(self.matches(string, exclude), limit))
+
+  # Returns the first limit (None means all) matches for string, in
+  # sorted order. Only limit matches are held at any time
+  def find(self, string, limit=None, exclude=()) :
+    key = lambda entry: (entry[0].lower(), entry[1])
+    if (limit is None) :
+      return sorted(self.matches(string, exclude), key=key)
+    return heapq.nsmallest(limit, self.matches(string, exclude), key=key)
+
 
 # 
 # Our table of autocomplete data.
 #
 class AutocompleteTable :
 
-  def __init__(self, sname, dname) :
+  # The columns fetched for autocomplete, and the field (see Fields) of each
+  rowColumns = tuple(column for columns in Fields.columns for column in columns)
+  rowFields = tuple(field for field in range(Fields.count) for column in Fields.columns[field])
+
+  # treeClass is the ternary tree engine to use: CompactTernaryTree (flat
+  # arrays) or Node (one object per character). Only the former can be
+  # saved to a snapshot.
+  # cacheBytes bounds the memory used by cached lookup results
+  def __init__(self, sname, dname, treeClass=CompactTernaryTree, cacheBytes=4*1024*1024) :
     self.sitename = sname
     self.datasetname = dname
+    self.treeClass = treeClass
+    self.cacheBytes = cacheBytes
     self.si = SoQLInterface(sname, dname)
-    # key: lower-case title/location
-    # value: correct case title/location
+    # key: lower-case title/location/actor/director
+    # value: correct case title/location/actor/director
 
     # Done this way to ensure atomic switchover
     # of the dataset. Alternatively, just make a new
     # autocomplete table
-    self.dataset = dict()
-    self.dataset['allTitles']            = dict()
-    self.dataset['allLocations']         = dict()
-    self.dataset['titleAutocomplete']    = Node()
-    self.dataset['locationAutocomplete'] = Node()
-
-  # Read in the autocomplete database
-  def fetchAutocomplete(self) :
-    newset = dict()
-    newset['allTitles']            = dict()
-    newset['allLocations']         = dict()
-    newset['titleAutocomplete']    = Node()
-    newset['locationAutocomplete'] = Node()
+    self.dataset = self.buildDataset([])
 
-    # Get the result list from the SFMOvie database
-    resultlist = self.si.doGet(
-              selectClause='locations,title',
-              cacheExpiration=0)
+  # Read in the autocomplete database. The tree is built as the rows come
+  # in, a page at a time, rather than once they all have
+  # version is the dataset version (from the metadata) being fetched, if known
+  # Returns False, leaving the dataset alone, if the fetch failed
+  def fetchAutocomplete(self, version=None) :
+    try:
+      self.dataset = self.buildDataset(self.iterRows(), version)
+    except SoQLError as e:
+      MUSTPRINT("Could not fetch autocomplete rows: %s"%str(e))
+      return False
+    return True
 
-    # Add title and locations
+  # Every distinct location in the dataset (e.g. for
+  # GoogleMapInterface.useAliases)
+  def locations(self) :
+    return [value for value, field in self.dataset['counts'] if (field == Fields.location)]
+
+  # Get the rows from the SFMOvie database, as they come in
+  # Raises SoQLError if they could not all be had
+  def iterRows(self) :
+    return self.si.iterRows(selectClause=",".join(AutocompleteTable.rowColumns))
+
+  # The row (tuple of rowColumns) of a result
+  @staticmethod
+  def toRow(result) :
+    return tuple([result.get(column) for column in AutocompleteTable.rowColumns])
+
+  # The tree holds one value per lower case string, so "Golden Gate Bridge"
+  # and "Golden gate bridge" are one suggestion. Rows are folded the same
+  # way before anything is counted: each value is replaced by the one
+  # already in display (lower case => value) for it, or else becomes it
+  @staticmethod
+  def foldRow(row, display) :
+    return tuple([value and display.setdefault(value.lower(), value) for value in row])
+
+  # Counts the (folded, see foldRow) rows (tuples of rowColumns) in a
+  # result list. This is what lets us tell which rows were added or removed
+  # between two fetches
+  @staticmethod
+  def countRows(resultlist, display) :
+    rowCounts = Counter()
+    for result in resultlist :
+      row = AutocompleteTable.toRow(result)
+      if (any(row)) :
+        rowCounts[AutocompleteTable.foldRow(row, display)] += 1
+    return rowCounts
+
+  # Counts the (value, field) entries in rowCounts: the number of rows
+  # with each title, location, actor and director. An actor listed twice
+  # in one row counts once
+  @staticmethod
+  def countEntries(rowCounts) :
+    counts = Counter()
+    for row, count in rowCounts.items() :
+      for entry in set(izip(row, AutocompleteTable.rowFields)) :
+        if (entry[0]) :
+          counts[entry] += count
+    return counts
+
+  # Builds a complete new dataset from a result list (or any iterable of
+  # results, such as iterRows, which is used up as it goes)
+  def buildDataset(self, resultlist, version=None) :
+    newset = dict()
+    newset['version']      = version
+    # When the dataset was last known to be at version (0 for never)
+    newset['checkedAt']    = time.time() if version is not None else 0
+    rowCounts = newset['rowCounts'] = Counter()
+    # Number of rows with each (value, field) entry
+    counts = newset['counts'] = Counter()
+    tree = newset['autocomplete'] = self.treeClass()
+    # key: lower-case value
+    # value: correct case value
+    allValues = newset['allValues'] = dict()
+
+    # Add every field into the one autocomplete Ternary tree, a row at a
+    # time. There is no need to add in "the" removed, "a" removed, etc.:
+    # the word index below lets "Rock" match "The Rock".
+    # The correct-case value rides along on the terminal node, so lookups
+    # need not go back through allValues.
+    # Popularity is the number of rows: for a title, the number of filming
+    # locations, for a location, the number of films made there, and so on.
+    # It only ever goes up as rows come in, and adding a string again with
+    # a higher weight just raises it
     for result in resultlist :
-      t = result.get('title')
-      if (t) :
-        lct = t.lower()
-        newset['allTitles'][lct] = t
-        # Now, add in "the" removed, "a" removed, etc.
-        # so that "Rock" will also match "The Rock"
-        # Bug not worth fixing:
-        # If there IS a "Rock" and a "The Rock", then we lose.      
-        # There are no such occurances in the database
-        m = re.match("(a|an|the)\s+(.*)",lct)
-        if (m) :
-          sublct = m.group(2)
-          newset['allTitles'][sublct] = t
-      loc = result.get('locations')
-      if (loc) :
-        lcl = loc.lower()
-        newset['allLocations'][lcl] = loc
-        # Now, add in "the" removed, "a" removed, etc.
-        m = re.match("(a|an|the)\s+(.*)",lcl)
-        if (m) :
-          sublcl = m.group(2)
-          newset['allLocations'][sublcl] = loc
-
-    # Now that we have built the "the" and upper->lowercase translation table,
-    # Let's start adding into the autocomplete Ternary tree itself
-    for title in newset['allTitles'].keys() :
-      if (title) :
-        newset['titleAutocomplete'].addString(title)
-    for location in newset['allLocations'].keys() :
-      if (location):
-        newset['locationAutocomplete'].addString(location)
+      row = AutocompleteTable.toRow(result)
+      if (not any(row)) :
+        continue
+      row = AutocompleteTable.foldRow(row, allValues)
+      rowCounts[row] += 1
+      # An actor listed twice in one row counts once (see countEntries)
+      for entry in set(izip(row, AutocompleteTable.rowFields)) :
+        value, field = entry
+        if (value) :
+          counts[entry] += 1
+          tree.addString(value.lower(), value, field, counts[entry])
+
+    # Matches in the middle of a value, at the start of a word
+    newset['tokens'] = TokenIndex(newset['counts'].keys(), newset['counts'])
+
+    # The first few keystrokes are both the most common and the most
+    # expensive queries, so answer them ahead of time
+    newset['prefixTable'] = AutocompleteTable.buildPrefixTable(newset)
+    # The rest are cached as they come in. The cache belongs to the dataset,
+    # so it is thrown out along with it
+    newset['responseCache'] = self.newResponseCache()
+    return newset
+
+  def newResponseCache(self) :
+    return LRUCache(maxsize=None, maxbytes=self.cacheBytes)
+
+  # Brings the dataset up to date with a freshly fetched result list (or
+  # any iterable of results, such as iterRows).
+  # Rather than building everything again, only the rows that were added
+  # or removed since the last fetch are applied, to a copy of the current
+  # dataset, which is then swapped in. Returns the number of rows changed
+  def applyRows(self, resultlist, version=None) :
+    dataset = self.dataset
+    if (not isinstance(dataset['autocomplete'], CompactTernaryTree)) :
+      # Node trees can't be copied cheaply, so just start over
+      self.dataset = self.buildDataset(resultlist, version)
+      return sum(self.dataset['rowCounts'].values())
+
+    # Case variants fold into the values already there
+    rowCounts = AutocompleteTable.countRows(resultlist, dict(dataset['allValues']))
+    added = rowCounts - dataset['rowCounts']
+    removed = dataset['rowCounts'] - rowCounts
+    newset = dict(dataset)
+    newset['version'] = version
+    newset['checkedAt'] = time.time()
+    if (not added and not removed) :
+      self.dataset = newset
+      return 0
+
+    newset['rowCounts'] = rowCounts
+    counts = newset['counts'] = Counter(dataset['counts'])
+    allValues = newset['allValues'] = dict(dataset['allValues'])
+    tree = newset['autocomplete'] = dataset['autocomplete'].copy()
+    addedEntries = AutocompleteTable.countEntries(added)
+    removedEntries = AutocompleteTable.countEntries(removed)
+    counts.update(addedEntries)
+    counts.subtract(removedEntries)
+    touched = set(addedEntries) | set(removedEntries)
+    # Either new, gone, or has a new weight
+    for entry in touched :
+      value, field = entry
+      if (counts[entry] > 0) :
+        allValues[value.lower()] = value
+        tree.addString(value.lower(), value, field, counts[entry])
+      else :
+        del counts[entry]
+        tree.removeString(value.lower(), field)
+    # A string is only gone once it is gone from every field
+    changed = set(value.lower() for value, field in touched)
+    for key in changed :
+      if (not tree.findString(key)) :
+        allValues.pop(key, None)
+
+    newset['tokens'] = TokenIndex(counts.keys(), counts)
+
+    # Only prefixes matching the start of a changed value, or the start of
+    # a word in one, need answering again
+    changedPrefixes = AutocompleteTable.shortPrefixes(changed)
+    validPrefixes = AutocompleteTable.shortPrefixes(allValues.keys())
+    prefixTable = dict(dataset['prefixTable'])
+    for prefix in changedPrefixes.union(prefixTable.keys()) :
+      if (prefix not in validPrefixes) :
+        prefixTable.pop(prefix, None)
+      elif (prefix in changedPrefixes or
+            [word for word in TokenIndex.words(prefix) if word in changedPrefixes]) :
+        prefixTable[prefix] = AutocompleteTable.toJSON(
+                                AutocompleteTable.toSuggestions(
+                                  AutocompleteTable.lookup(newset, prefix)))
+    newset['prefixTable'] = prefixTable
+    newset['responseCache'] = self.newResponseCache()
     self.dataset = newset
+    changes = sum(added.values()) + sum(removed.values())
+    INFOPRINT("Applied %d changed autocomplete rows"%changes, 3)
+    return changes
 
-  # Returns a dict of lists
-  # locations = list
+  # Snapshot file layout:
+  # magic line, 4 byte little endian header length, JSON header, then the
+  # raw contents of each array, each starting on an 8 byte boundary. The
+  # header holds everything that is not an array, and the
+  # (name, typecode, offset, count) of every array
+  snapshotMagic = "MGCHALLENGE2014 AUTOCOMPLETE SNAPSHOT 4\n"
+
+  # Writes the current dataset out to path, so that the next instance
+  # can start up from it instead of the SFMovie database.
+  # Returns True on success. The file is written to the side and renamed
+  # into place so that a reader never sees half of it
+  def saveSnapshot(self, path) :
+    dataset = self.dataset
+    tree = dataset['autocomplete']
+    if (not isinstance(tree, CompactTernaryTree)) :
+      MUSTPRINT("Can't snapshot a %s autocomplete tree"%tree.__class__.__name__)
+      return False
+    tokens = dataset['tokens']
+    header = dict()
+    header['createdAt'] = time.time()
+    header['version'] = dataset['version']
+    # The counts and allValues are quick to work out again from the rows
+    header['rowCounts'] = [list(row) + [count] for row, count in dataset['rowCounts'].items()]
+    header['prefixTable'] = dataset['prefixTable']
+    header['autocomplete'] = { 'root' : tree.root, 'valueTable' : tree.valueTable }
+    header['tokens'] = { 'values' : tokens.values, 'postings' : tokens.postings }
+    header['sections'] = list()
+    arrays = list()
+    for name, data in tree.snapshotArrays().items() :
+      arrays.append(("autocomplete." + name, data))
+    arrays.append(("tokens.fields", tokens.fields))
+    arrays.append(("tokens.postingData", tokens.postingData))
+
+    # Lay out the arrays after the header
+    offset = 0
+    for name, data in arrays :
+      header['sections'].append([name, data.typecode, offset, len(data)])
+      offset += (data.itemsize * len(data) + 7) & ~7
+    headerString = json.dumps(header)
+    start = len(AutocompleteTable.snapshotMagic) + 4 + len(headerString)
+    start = (start + 7) & ~7
+
+    tmppath = "%s.%s.tmp"%(path, InstanceId())
+    try :
+      f = open(tmppath, "wb")
+      try :
+        f.write(AutocompleteTable.snapshotMagic)
+        f.write(struct.pack("<I", len(headerString)))
+        f.write(headerString)
+        for section, (name, data) in zip(header['sections'], arrays) :
+          f.seek(start + section[2])
+          data.tofile(f)
+      finally :
+        f.close()
+      os.rename(tmppath, path)
+    except Exception as e :
+      # The App Engine file system is read only, so this is not
+      # unexpected there
+      MUSTPRINT("Could not save autocomplete snapshot to %s: %s"%(path, str(e)))
+      try :
+        os.remove(tmppath)
+      except :
+        pass
+      return False
+    INFOPRINT("Saved autocomplete snapshot to %s"%path, 3)
+    return True
+
+  # Replaces the dataset with the one in the snapshot at path.
+  # Returns False (and leaves the dataset alone) if the snapshot is
+  # missing, unreadable, or older than maxAgeSeconds
+  def loadSnapshot(self, path, maxAgeSeconds=None) :
+    try :
+      f = open(path, "rb")
+    except IOError :
+      return False
+    try :
+      mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception as e :
+      f.close()
+      MUSTPRINT("Could not map autocomplete snapshot %s: %s"%(path, str(e)))
+      return False
+    try :
+      magic = AutocompleteTable.snapshotMagic
+      if (mapped[:len(magic)] != magic) :
+        MUSTPRINT("%s is not an autocomplete snapshot"%path)
+        return False
+      headerLength = struct.unpack("<I", mapped[len(magic):len(magic)+4])[0]
+      header = json.loads(mapped[len(magic)+4:len(magic)+4+headerLength])
+      age = time.time() - header['createdAt']
+      if (maxAgeSeconds is not None and age > maxAgeSeconds) :
+        INFOPRINT("Autocomplete snapshot %s is stale (%d seconds old)"%(path, age), 3)
+        return False
+      start = (len(magic) + 4 + headerLength + 7) & ~7
+
+      # Bulk copy each array straight out of the mapping
+      arrays = dict()
+      for name, typecode, offset, count in header['sections'] :
+        data = array(str(typecode))
+        begin = start + offset
+        data.fromstring(mapped[begin:begin + data.itemsize * count])
+        arrays[name] = data
+
+      newset = dict()
+      newset['version'] = header['version']
+      newset['checkedAt'] = header['createdAt'] if header['version'] is not None else 0
+      newset['rowCounts'] = Counter()
+      for row in header['rowCounts'] :
+        newset['rowCounts'][tuple(row[:-1])] = row[-1]
+      newset['counts'] = AutocompleteTable.countEntries(newset['rowCounts'])
+      newset['allValues'] = dict((value.lower(), value) for value, field in newset['counts'])
+      newset['prefixTable'] = header['prefixTable']
+      treearrays = dict((name.split(".", 1)[1], data) for name, data in arrays.items()
+                        if name.startswith("autocomplete."))
+      newset['autocomplete'] = CompactTernaryTree.fromSnapshot(header['autocomplete']['root'],
+                                                               treearrays,
+                                                               header['autocomplete']['valueTable'])
+      tokens = TokenIndex()
+      tokens.values = header['tokens']['values']
+      tokens.postings = header['tokens']['postings']
+      tokens.fields = arrays["tokens.fields"]
+      tokens.postingData = arrays["tokens.postingData"]
+      newset['tokens'] = tokens
+      newset['responseCache'] = self.newResponseCache()
+    except Exception as e :
+      MUSTPRINT("Could not load autocomplete snapshot %s: %s"%(path, str(e)))
+      return False
+    finally :
+      mapped.close()
+      f.close()
+    self.dataset = newset
+    INFOPRINT("Loaded autocomplete snapshot %s (%d seconds old)"%(path, age), 3)
+    return True
+
+  # Builds a dict of every 1, 2 and 3 character prefix in the dataset
+  # (of whole strings or of words in them) to the finished (JSON-encoded)
+  # JQuery.Autocomplete response
+  @staticmethod
+  def buildPrefixTable(dataset, maxlength=3) :
+    prefixes = AutocompleteTable.shortPrefixes(dataset['allValues'].keys(), maxlength)
+    table = dict()
+    for prefix in prefixes :
+      matches = AutocompleteTable.lookup(dataset, prefix)
+      table[prefix] = AutocompleteTable.toJSON(
+                        AutocompleteTable.toSuggestions(matches))
+    return table
+
+  # Returns the set of 1 to maxlength character prefixes of the keys,
+  # and of the words in them
+  @staticmethod
+  def shortPrefixes(keys, maxlength=3) :
+    prefixes = set()
+    for key in keys :
+      for word in [key] + TokenIndex.words(key) :
+        for length in range(1, min(len(word), maxlength)+1) :
+          prefixes.add(word[:length])
+    return prefixes
+
+  # Returns the precomputed JSON response for string, or None if
+  # it has to be looked up the long way
+  def getPrecomputed(self, string) :
+    return self.dataset['prefixTable'].get(string.lower())
+
+  # Suggestion orders: most popular first, or alphabetical
+  byWeight = "weight"
+  byName = "name"
+
+  # Returns a dict of lists, one per field (see Fields.names)
   # title = list
-  def doAutocomplete(self, string) :
-    retval = dict()
+  # locations = list
+  # actor = list
+  # director = list
+  # The suggestions are the values starting with string, followed by those
+  # with a word starting with it. If fuzzy is set (1 or 2), these are
+  # followed by values starting with something within that many typos
+  # of string, closest first.
+  # Within each of those, values are ordered by order: most popular
+  # first (byWeight), or alphabetically (byName).
+  # No more than limit suggestions are returned in all (None means no limit)
+  def doAutocomplete(self, string, limit=None, fuzzy=0, order=byWeight) :
     # Keep us threadsafe, and keep our own ref to
     # the dataset, lest another thread refresh it
     # halfway thru our work
-    dataset = self.dataset
-    retval['title'] = map((lambda title: dataset['allTitles'][title]),
-                  sorted(list(
-                      dataset['titleAutocomplete'].getAutocomplete(string.lower()))))
-    retval['locations'] = map((lambda loc: dataset['allLocations'][loc]),
-                  sorted(list
-                      (dataset['locationAutocomplete'].getAutocomplete(string.lower()))))
+    retval = dict((name, list()) for name in Fields.names)
+    for key, (value, field) in AutocompleteTable.cachedLookup(self.dataset, string, limit, fuzzy, order) :
+      retval[Fields.names[field]].append(value)
+    return retval
+
+  # Like doAutocomplete, but returns JQuery.Autocomplete suggestions
+  # (see toSuggestions)
+  def getSuggestions(self, string, limit=None, fuzzy=0, order=byWeight) :
+    return AutocompleteTable.toSuggestions(
+             AutocompleteTable.cachedLookup(self.dataset, string, limit, fuzzy, order))
+
+  # Typo tolerance is capped at 2, and is only allowed once the query is
+  # long enough that the typos do not swamp it
+  maxFuzzy = 2
+
+  # Does the work for doAutocomplete: one walk of the tree and of the word
+  # index finds the matches in every field. Returns a list of
+  # (sort key, (value, field)) pairs, in sort key order.
+  # The sort key is (kind of match, -weight (or 0 for byName), lower case value, field),
+  # where the kind of match is 0 for a prefix, 1 for a word start and
+  # 1 + typos for a fuzzy match
+  @staticmethod
+  def lookup(dataset, string, limit=None, fuzzy=0, order=byWeight) :
+    lcstring = string.lower()
+    tree = dataset['autocomplete']
+    counts = dataset['counts']
+    byWeight = (order == AutocompleteTable.byWeight)
+    if (byWeight) :
+      weight = lambda entry: -counts.get(entry, 0)
+      matches = tree.getTopCompletions(lcstring, limit)
+    else :
+      weight = lambda entry: 0
+      matches = tree.getCompletions(lcstring, limit)
+    ranked = [((0, weight(entry), entry[0].lower(), entry[1]), entry) for entry in matches]
+
+    if (limit is None or len(ranked) < limit) :
+      room = None if limit is None else limit - len(ranked)
+      if (byWeight) :
+        matches = dataset['tokens'].findTop(lcstring, room, set(matches))
+      else :
+        matches = dataset['tokens'].find(lcstring, room, set(matches))
+      ranked.extend(((1, weight(entry), entry[0].lower(), entry[1]), entry) for entry in matches)
+
+    maxdist = min(fuzzy, AutocompleteTable.maxFuzzy, len(lcstring) - 2)
+    if (maxdist > 0 and (limit is None or len(ranked) < limit)) :
+      exact = set(entry for key, entry in ranked)
+      distances = tree.getFuzzyCompletions(lcstring, maxdist)
+      fuzzymatches = sorted(((1 + distance, weight(entry), entry[0].lower(), entry[1]), entry)
+                            for entry, distance in distances.items() if entry not in exact)
+      ranked.extend(fuzzymatches if limit is None else fuzzymatches[:limit - len(ranked)])
+    # Prevent needless generation of strings
+    if (ISLEVEL(1)) : INFOPRINT("THERE ARE %d suggestions"%len(ranked),1)
+    return ranked
+
+  # Like lookup, but goes through the dataset's response cache, which holds
+  # lookup results by (lower case query, order).
+  # Every match for a query also matches any prefix of it, so on a miss, a
+  # complete (not cut short by a limit) result for a shorter prefix is
+  # filtered down instead of walking the tree and word index again.
+  # Fuzzy lookups are not cached
+  @staticmethod
+  def cachedLookup(dataset, string, limit=None, fuzzy=0, order=byWeight) :
+    lcstring = string.lower()
+    if (min(fuzzy, AutocompleteTable.maxFuzzy, len(lcstring) - 2) > 0) :
+      return AutocompleteTable.lookup(dataset, lcstring, limit, fuzzy, order)
+    cache = dataset['responseCache']
+    # Cache entries are (complete, ranked)
+    entry = cache.get((lcstring, order))
+    if (entry is not None and (entry[0] or (limit is not None and len(entry[1]) >= limit))) :
+      return entry[1] if limit is None else entry[1][:limit]
+
+    ranked = None
+    words = TokenIndex.words(lcstring)
+    for length in range(len(lcstring) - 1, 0, -1) :
+      prefix = lcstring[:length]
+      if (not AutocompleteTable.canRefine(prefix, words)) :
+        continue
+      entry = cache.get((prefix, order))
+      if (entry is not None and entry[0]) :
+        ranked = AutocompleteTable.refine(entry[1], lcstring)
+        complete = True
+        break
+    if (ranked is None) :
+      ranked = AutocompleteTable.lookup(dataset, lcstring, limit, 0, order)
+      complete = (limit is None or len(ranked) < limit)
+    cache.put((lcstring, order), (complete, ranked), size=AutocompleteTable.rankedBytes(ranked))
+    return ranked if limit is None else ranked[:limit]
+
+  # Whether the lookup result for prefix holds every match for a longer
+  # string whose words are words. It holds the literal prefix matches, but
+  # the word start matches only if prefix has words, and each of them is
+  # the start of the string's word in the same place: " " and "(" have no
+  # words, so the result for either has none of the word start matches
+  # for " s" or "(s"
+  @staticmethod
+  def canRefine(prefix, words) :
+    if (not words) :
+      return True
+    prefixWords = TokenIndex.words(prefix)
+    if (not prefixWords or len(prefixWords) > len(words)) :
+      return False
+    for prefixWord, word in izip(prefixWords, words) :
+      if (not word.startswith(prefixWord)) :
+        return False
+    return True
+
+  # Given ranked, the complete lookup result for a prefix of lcstring,
+  # returns the lookup result for lcstring: the matches that still match,
+  # each ranked again as a prefix or word start match
+  @staticmethod
+  def refine(ranked, lcstring) :
+    words = TokenIndex.words(lcstring)
+    retval = list()
+    for key, entry in ranked :
+      lower = key[2]
+      if (lower.startswith(lcstring)) :
+        retval.append(((0,) + key[1:], entry))
+      elif (words and AutocompleteTable.hasWordStarts(lower, words)) :
+        retval.append(((1,) + key[1:], entry))
+    # Each kind of match is still in order, so this is just a merge
+    retval.sort()
     return retval
 
+  # True if for every word in words, string has a word starting with it,
+  # which is what TokenIndex matches
+  @staticmethod
+  def hasWordStarts(string, words) :
+    stringWords = TokenIndex.words(string)
+    for word in words :
+      if (not [w for w in stringWords if w.startswith(word)]) :
+        return False
+    return True
+
+  # Rough memory footprint of a lookup result: the list, and for each
+  # match, its tuples and lower case string
+  @staticmethod
+  def rankedBytes(ranked) :
+    size = sys.getsizeof(ranked)
+    for item in ranked :
+      key = item[0]
+      size += sys.getsizeof(item) + sys.getsizeof(key) + sys.getsizeof(item[1]) + sys.getsizeof(key[2])
+    return size
+
+  # Turns the list from lookup into JQuery.Autocomplete suggestions, in
+  # the same order. The value is the title, location, actor or director,
+  # the data is the search command to run when it is picked (see
+  # Fields.commands)
+  @staticmethod
+  def toSuggestions(ranked) :
+    return [{ 'value' : value, 'data' : Fields.commands[field] }
+            for key, (value, field) in ranked]
+
+  # The JSON response JQuery.Autocomplete expects
+  @staticmethod
+  def toJSON(suggestions) :
+    return json.dumps({'query' : "Unit", 'suggestions' : suggestions})
+
+
+#
+# Keeps an AutocompleteTable up to date. Each refresh asks the dataset's
+# metadata (the /api/views/<dataset> URL) when its rows were last updated.
+# If that has not changed since the last look, nothing else is done.
+# Otherwise, the rows are fetched and the changes are applied to the table
+# (see AutocompleteTable.applyRows).
+#
+# There is no thread of its own to do this every so often: on App Engine,
+# a thread started in a request does not outlive it. Whoever wants the
+# table kept up to date calls refresh (e.g. cron, through cmd=refresh).
+#
+# Listeners are called with no arguments after the table has changed,
+# e.g. to throw away cached autocomplete responses.
+#
+class AutocompleteRefresher(object) :
+  def __init__(self, actable, metadataurl, snapshotfile=None) :
+    self.actable = actable
+    self.metadataurl = metadataurl
+    self.snapshotfile = snapshotfile
+    self.listeners = list()
+    self.decoder = json.JSONDecoder()
+    # For refreshIfOlder: only one caller checks at a time, and after a
+    # check that failed, not again until retryAt
+    self.lock = Lock()
+    self.retryAt = 0
+
+  def addListener(self, listener) :
+    self.listeners.append(listener)
+
+  # Returns the version (last row update time) of the dataset as a string,
+  # or None if the metadata could not be had
+  def fetchVersion(self) :
+    try:
+      statusCode, metadata = SoQLInterface.transport.get(self.metadataurl)
+      if (statusCode < 200 or statusCode >= 300) :
+        INFOPRINT("Error code %d from metadata url \"%s\""%(statusCode, self.metadataurl), 5)
+        return None
+    except Exception as e:
+      INFOPRINT("Could not fetch metadata from \"%s\": %s"%(self.metadataurl, str(e)), 5)
+      return None
+    version = metadata.get('rowsUpdatedAt')
+    if (version is None) :
+      version = metadata.get('viewLastModified')
+    return None if version is None else str(version)
+
+  # Checks the metadata, and brings the table up to date if the dataset
+  # has changed. Returns True if the table changed
+  def refresh(self) :
+    version = self.fetchVersion()
+    if (version is None) :
+      return False
+    if (version == self.actable.dataset['version']) :
+      self.actable.dataset['checkedAt'] = time.time()
+      return False
+    try:
+      changes = self.actable.applyRows(self.actable.iterRows(), version)
+    except SoQLError as e:
+      MUSTPRINT("Could not fetch autocomplete rows: %s"%str(e))
+      return False
+    MUSTPRINT("Autocomplete dataset now at version %s, %d rows changed"%(version, changes))
+    if (self.snapshotfile) :
+      self.actable.saveSnapshot(self.snapshotfile)
+    if (changes) :
+      for listener in self.listeners :
+        listener()
+    return changes > 0
+
+  # refresh, but only if the table was last known to be current more than
+  # maxAgeSeconds ago (say, it came from a snapshot shipped with the app),
+  # and no one else is already at it. A check that fails is not tried
+  # again for retrySeconds. Returns True if the table changed
+  def refreshIfOlder(self, maxAgeSeconds, retrySeconds=300) :
+    now = time.time()
+    if (now - self.actable.dataset['checkedAt'] <= maxAgeSeconds or now < self.retryAt) :
+      return False
+    if (not self.lock.acquire(False)) :
+      return False
+    try:
+      if (time.time() - self.actable.dataset['checkedAt'] <= maxAgeSeconds) :
+        return False
+      self.retryAt = now + retrySeconds
+      return self.refresh()
+    finally:
+      self.lock.release()
+
+
+# Rows (dicts of rowColumns) for checkRefresh: count titles, each filmed at
+# a few locations, with a few actors
+def standInRows(count) :
+  rows = list()
+  for i in range(count) :
+    for j in range(1 + i % 3) :
+      rows.append({ 'title' : "Title %d"%i,
+                    'locations' : "%d Market Street"%(i * 7 % (count / 2 + 1) + j),
+                    'actor_1' : "Actor %d"%(i % 17),
+                    'actor_2' : "Actor %d"%(i % 5 + 20) if i % 2 else None,
+                    'director' : "Director %d"%(i % 11) })
+  return rows
+
+# Every difference between the datasets of two AutocompleteTables, as a
+# list of strings (empty if they are the same): the version, the counts,
+# the prefix table, and the answer to every 1 to 3 character prefix and
+# every full value, exact and fuzzy
+def datasetDifferences(table, expected) :
+  retval = list()
+  for name in ('version', 'rowCounts', 'counts', 'allValues', 'prefixTable') :
+    if (table.dataset[name] != expected.dataset[name]) :
+      retval.append("%s differs"%name)
+  queries = set()
+  for key in table.dataset['allValues'].keys() + expected.dataset['allValues'].keys() :
+    queries.update([key[:1], key[:2], key[:3], key])
+  for query in sorted(q for q in queries if q) :
+    for fuzzy in (0, 1) :
+      if (table.doAutocomplete(query, None, fuzzy) != expected.doAutocomplete(query, None, fuzzy)) :
+        retval.append("\"%s\" (fuzzy %d) differs"%(query, fuzzy))
+  return retval
+
+# Checks AutocompleteRefresher (and AutocompleteTable.applyRows) against a
+# local DatasetStandIn (see standin.py), for both tree engines: an
+# unchanged version must leave the dataset alone (only noting that it was
+# checked), and a changed one must leave it just as a full rebuild from
+# the new rows would.
+# Returns a list of what went wrong (empty if nothing did)
+def checkRefresh(count=300) :
+  from standin import DatasetStandIn
+  server = DatasetStandIn().start()
+  sname = "localhost:%d"%server.port()
+  metadataurl = server.url("/api/views/standin")
+  scheme = SoQLInterface.scheme
+  SoQLInterface.scheme = "http"
+  rows = standInRows(count)
+  # Some rows gone, some new, one more of some, and a case variant of a
+  # value that is still there
+  changed = [row for i, row in enumerate(rows) if i % 9]
+  changed.extend(standInRows(count + 20)[-25:])
+  changed.extend(rows[:3])
+  changed.append(dict(rows[0], title=rows[0]['title'].upper()))
+  failures = list()
+  try:
+    for engine in (Node, CompactTernaryTree) :
+      server.version = "1"
+      server.rows = rows
+      table = AutocompleteTable(sname, "standin", engine)
+      refresher = AutocompleteRefresher(table, metadataurl)
+      if (not table.fetchAutocomplete(refresher.fetchVersion())) :
+        failures.append("%s: could not fetch version 1"%engine.__name__)
+        continue
+      dataset = table.dataset
+      if (refresher.refresh() or table.dataset is not dataset) :
+        failures.append("%s: unchanged version was not a no-op"%engine.__name__)
+      # As if it had come from an old snapshot
+      dataset['checkedAt'] = 0
+      if (refresher.refreshIfOlder(3600) or table.dataset is not dataset or
+          time.time() - dataset['checkedAt'] > 3600) :
+        failures.append("%s: old, unchanged table was not just marked checked"%engine.__name__)
+
+      server.version = "2"
+      server.rows = changed
+      if (not refresher.refresh()) :
+        failures.append("%s: changed version was not applied"%engine.__name__)
+      rebuilt = AutocompleteTable(sname, "standin", engine)
+      rebuilt.fetchAutocomplete("2")
+      failures.extend("%s: %s"%(engine.__name__, difference)
+                      for difference in datasetDifferences(table, rebuilt))
+  finally:
+    SoQLInterface.scheme = scheme
+    server.stop()
+  return failures
+
+
+#
+# Memory and latency comparison of the two tree engines.
+# Node memory is estimated from the size of each node object and its
+# attribute dict; CompactTernaryTree memory is its array buffers.
+#
+def nodeTreeStats(root) :
+  count = 0
+  size = 0
+  stack = [root]
+  while stack :
+    node = stack.pop()
+    count += 1
+    size += sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+    for child in (node.left, node.right, node.center) :
+      if child != 0 :
+        stack.append(child)
+  return count, size
+
+def compareEngines(sname, dname, rounds=5) :
+  tables = dict()
+  for engine in (Node, CompactTernaryTree) :
+    table = AutocompleteTable(sname, dname, engine)
+    start = time.time()
+    table.fetchAutocomplete()
+    print("%s: fetch and build took %d ms"%(engine.__name__, (time.time()-start)*1000))
+    tables[engine] = table
+
+  for engine, table in tables.items() :
+    tree = table.dataset['autocomplete']
+    if (engine is Node) :
+      count, size = nodeTreeStats(tree)
+    else :
+      count, size = tree.nodeCount(), tree.sizeInBytes()
+    print("%s: %d nodes, ~%d KB"%(engine.__name__, count, size/1024))
+
+  # Every 1, 2 and 3 character prefix in the data, plus the full keys
+  dataset = tables[Node].dataset
+  queries = set()
+  for key in dataset['allValues'].keys() :
+    queries.update([key[:1], key[:2], key[:3], key])
+  queries = sorted(q for q in queries if q)
+
+  for engine, table in tables.items() :
+    start = time.time()
+    for i in range(rounds) :
+      for query in queries :
+        AutocompleteTable.lookup(table.dataset, query)
+    elapsed = time.time() - start
+    print("%s: %d queries, %.1f usec per query"%(engine.__name__, len(queries),
+                                                 elapsed * 1000000 / (rounds * len(queries))))
+
+  # Typo tolerance: drop a character from the middle of each full key
+  typos = sorted(set(q[:2] + q[3:] for q in queries if len(q) >= 6))
+  for engine, table in tables.items() :
+    start = time.time()
+    for query in typos :
+      table.doAutocomplete(query, None, 1)
+    elapsed = time.time() - start
+    print("%s: %d fuzzy queries, %.1f usec per query"%(engine.__name__, len(typos),
+                                                 elapsed * 1000000 / len(typos)))
+
+  # And make sure the two engines agree
+  for query in queries :
+    if (tables[Node].doAutocomplete(query) != tables[CompactTernaryTree].doAutocomplete(query)) :
+      print("MISMATCH for \"%s\""%query)
+
+
+# Main: engine comparison against the full SF dataset, or with "refresh",
+# the refresher check against a local stand-in
+if __name__ == '__main__':
+  if (sys.argv[1:] == ["refresh"]) :
+    failures = checkRefresh()
+    for failure in failures :
+      print("MISMATCH: %s"%failure)
+    print("FAILED" if failures else "OK")
+    sys.exit(1 if failures else 0)
+  compareEngines("data.sfgov.org", "yitu-d5am")
@@ -57,24 +57,43 @@ class Autotests :
                       {"query" : "Vertigo",  "title" : "Vertigo"},
                       {"query" : "Vertifrimbulmongers",  "title" : 0 },
                       {"query" : "Vertigofrimbulmongers",  "title" : 0 },
-                      # And make sure the "the" remover is working
+                      # And make sure word starts are matched, so that
+                      # the "the" is skipped over
                       {"query" : "Jitney",  "title" : "A Jitney*" }
                     ])
     
       Autotests.autocompleteTest(ac,
                     [{ "query" : "2",  'locations' : "2417 Franklin Street"},
                       { "query" : "24",  'locations': "2417 Franklin Street"},
-                      { "query" : "2417Franklin",  'locations' : 0}
+                      { "query" : "2417Franklin",  'locations' : 0},
+                      # Word starts in the middle of a location
+                      { "query" : "Franklin",  'locations': "2417 Franklin Street"},
+                      { "query" : "Bridge",  'locations': "Golden Gate Bridge"},
+                      { "query" : "Frank 24",  'locations': "2417 Franklin Street"}
                     ])
 
       # Spaces SHOULD NOT work, unless there really is a leading space
       Autotests.autocompleteTest(ac,
                     [{"query" : " 2", 'locations': None}])
 
+      # A query with no word in it only matches literally, so what is
+      # cached for it must not be narrowed down for a longer query that
+      # has one (the first of each pair is only there to be cached)
+      Autotests.autocompleteTest(ac,
+                    [{"query" : " "},
+                     {"query" : " s", 'locations': "2417 Franklin Street", 'title': "\\(Sic\\) Story"},
+                     {"query" : "("},
+                     {"query" : "(s", 'locations': "2417 Franklin Street"}])
+
       # And finally, make sure we're getting simultaneous titles and locations
       Autotests.autocompleteTest(ac,
                     [{"query" : "Pal", 'locations': "Palace of Fine*", 'title': "Pal Joey"}])
 
+      # Actors and directors come out of the same index
+      Autotests.autocompleteTest(ac,
+                    [{"query" : "Hitchcock", 'director': "Alfred Hitchcock"},
+                     {"query" : "James St", 'actor': "James Stewart"}])
+
     # Now make sure we can get at least four map points for Vertigo
     if (gi and si) :
       MUSTPRINT("TESTING Map Search:")
@@ -112,7 +131,7 @@ class Autotests :
       for test in testList :
         query = test.get('query')
         result = ai.doAutocomplete(query)
-        for testtype in ['title', 'locations'] :
+        for testtype in ['title', 'locations', 'actor', 'director'] :
           regexp = test.get(testtype)
           # No test for this kind
           if (regexp is None) :
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Code Challenge for Mark Gerolimatos
+# (SF Movie Database)
+# mark@gerolimatos.com
+# 650 703-4774
+# (c) Mark Gerolimatos, save for code borrowed and credited
+#
+# October, 2014
+#
+from __future__ import print_function
+
+#
+# Offline bulk geocoding. A first time title search with 30 locations means
+# 30 paid geocode calls, one after the other, while the user waits. This job
+# geocodes every distinct location in the dataset ahead of time instead, and
+# writes them to the GeocodeTable that the app loads on startup (see
+# GoogleMapInterface.useTable).
+#
+# It is run by hand, outside the App Engine:
+#   python geocodebatch.py --key <API key>
+# It may be stopped (or run out of quota) at any point: the table is
+# appended to as it goes, and the next run only does the locations that
+# are not in it yet.
+#
+# For testing, it can be pointed at a stand-in geocoder on this machine:
+#   python geocodebatch.py --standin 8765 &
+#   python geocodebatch.py --url http://localhost:8765/geocode --table /tmp/geocode.table
+#
+
+from BaseImport import *
+from soqlinterface import *
+from googleinterface import *
+import requests, argparse
+
+# Where the app expects the table
+defaultTable = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode.table")
+
+
+class GeocodeBatch :
+  # Google statuses that mean there is no point going on today. Whatever
+  # is left is done by the next run
+  stopStatuses = ("OVER_QUERY_LIMIT", "REQUEST_DENIED")
+
+  def __init__(self, tablePath, geocodeUrl=Default, apiKey=GOOGLE_API_KEY, qps=10.0) :
+    if geocodeUrl is Default:
+      geocodeUrl = GoogleMapInterface.geocodeUrl
+    self.tablePath = tablePath
+    self.geocodeUrl = geocodeUrl
+    self.apiKey = apiKey
+    self.limiter = RateLimiter(qps)
+    self.decoder = json.JSONDecoder()
+
+  # Every distinct location in the dataset, as it appears there
+  @staticmethod
+  def distinctLocations(soql) :
+    rows = soql.doGet(selectClause="locations", groupClause="locations")
+    return [row['locations'] for row in rows if row.get('locations')]
+
+  # Returns (status, geoLookup result). The result is None unless the
+  # location may go in the table (found, or definitely not found)
+  def geocode(self, key) :
+    # Never sheds: there is no maxWait
+    self.limiter.acquire()
+    url = self.geocodeUrl + "?address=" + key
+    if (self.apiKey) :
+      url += "&key=" + self.apiKey
+    try:
+      # The mysterious 6.05 seconds on connect timeout is to prevent
+      # TCP from opening the connetion just as we give up
+      response = requests.get(url, timeout=(6.05, 22))
+      dic = self.decoder.decode(response.content)
+      status = dic.get('status', "OK")
+      if (status not in ("OK", "ZERO_RESULTS")) :
+        return status, None
+      geoinfo, ttl = GoogleMapInterface.parseGeocode(dic)
+    except Exception as e:
+      return str(e), None
+    if (geoinfo.get('errmsg')) :
+      return geoinfo['errmsg'], None
+    return status, geoinfo
+
+  # Geocodes every one of locations (all of them in the dataset) not
+  # already in the table, appending
+  # them to it as it goes. Stops early after limit calls, if given.
+  # Returns a dict of counts
+  def run(self, locations, limit=None) :
+    # Variants of one place are only paid for once
+    GoogleMapInterface.useAliases(locations)
+    known = set()
+    nextId = 0
+    for locationId, location, geoinfo in GeocodeTable.rows(self.tablePath) :
+      known.add(GoogleMapInterface.locationKey(location, False))
+      nextId = max(nextId, locationId + 1)
+
+    counts = { 'known' : len(known), 'added' : 0, 'notfound' : 0, 'failed' : 0, 'left' : 0 }
+    todo = list()
+    for location in locations :
+      if (isinstance(location, unicode)) :
+        location = location.encode("utf-8")
+      location = " ".join(location.split())
+      key = GoogleMapInterface.locationKey(location, False)
+      if (key not in known) :
+        known.add(key)
+        todo.append((key, location))
+
+    with open(self.tablePath, "a") as outfile :
+      for i, (key, location) in enumerate(todo) :
+        if (limit is not None and i >= limit) :
+          counts['left'] = len(todo) - i
+          break
+        status, geoinfo = self.geocode(key)
+        if (geoinfo is None) :
+          MUSTPRINT("Geocode of \"%s\" failed: %s"%(location, status))
+          counts['failed'] += 1
+          if (status in GeocodeBatch.stopStatuses) :
+            counts['left'] = len(todo) - i - 1
+            break
+          continue
+        if (geoinfo.get('latitude') is None) :
+          counts['notfound'] += 1
+        outfile.write(GeocodeTable.formatRow(nextId, location, geoinfo))
+        # So that a killed run loses at most the one location
+        outfile.flush()
+        nextId += 1
+        counts['added'] += 1
+        if (ISLEVEL(1)) : INFOPRINT("%d/%d %s"%(i + 1, len(todo), location), 1)
+    return counts
+
+
+
+# Geocode cache hit rates over locations (every filming location row in the
+# dataset, say), as if each were looked up once, in order, starting from an
+# empty cache. "before" keys only normalize case and whitespace, "after"
+# keys are canonical, with the aliases built from the same locations.
+# Returns a dict of results
+def keyReport(locations) :
+  locations = [location.encode("utf-8") if isinstance(location, unicode) else location
+               for location in locations if location]
+  distinct = set(locations)
+  GoogleMapInterface.useAliases(distinct)
+  retval = { 'lookups' : len(locations), 'distinct' : len(distinct) }
+  for name, canonical in (("before", False), ("after", True)) :
+    keys = set(GoogleMapInterface.locationKey(location, False, canonical) for location in distinct)
+    retval[name] = { 'keys'    : len(keys),
+                     'hitRate' : 1 - len(keys) / float(max(1, len(locations))),
+                     'distinctHitRate' : 1 - len(keys) / float(max(1, len(distinct))) }
+  return retval
+
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Geocode every location in the SF movie dataset ahead of time")
+  parser.add_argument("--table", default=defaultTable, help="table to write (and resume)")
+  parser.add_argument("--url", default=GoogleMapInterface.geocodeUrl, help="geocoder to use")
+  parser.add_argument("--key", default=GOOGLE_API_KEY, help="geocoder API key")
+  parser.add_argument("--qps", type=float, default=10.0, help="most geocode calls per second")
+  parser.add_argument("--limit", type=int, default=None, help="most geocode calls this run")
+  parser.add_argument("--site", default="data.sfgov.org")
+  parser.add_argument("--dataset", default="yitu-d5am")
+  parser.add_argument("--report", action="store_true",
+                      help="print geocode cache hit rates for the dataset's locations instead")
+  parser.add_argument("--standin", type=int, default=None, metavar="PORT",
+                      help="serve a stand-in geocoder on PORT instead")
+  args = parser.parse_args()
+
+  if (args.standin is not None) :
+    from standin import GeocodeStandIn
+    server = GeocodeStandIn(args.standin)
+    print("Stand-in geocoder on %s"%server.url("/geocode"))
+    server.serve_forever()
+
+  if (args.report) :
+    rows = SoQLInterface(args.site, args.dataset).doGet(selectClause="locations")
+    print(json.dumps(keyReport([row.get('locations') for row in rows]), indent=2))
+    sys.exit(0)
+
+  locations = GeocodeBatch.distinctLocations(SoQLInterface(args.site, args.dataset))
+  print("%d distinct locations"%len(locations))
+  batch = GeocodeBatch(args.table, args.url, args.key, args.qps)
+  print(json.dumps(batch.run(locations, args.limit)))
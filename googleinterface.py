@@ -11,11 +11,15 @@
 
 from BaseImport import *
 from simplecache import *
-import urllib
+import urllib, Queue, functools
 #import requests
 # This is unreal...there are issues with the Google App Engine and urllib.
 # backing off to urlfetch in the app engine
-from google.appengine.api import urlfetch
+try:
+  from google.appengine.api import urlfetch
+except ImportError:
+  # Outside the App Engine (geocodebatch.py), which does its own fetching
+  urlfetch = None
 import json
 
 ##### OUR GOOGLE API KEY
@@ -88,6 +92,63 @@ class SFBounds :
       return retval
     return SFBounds.sfo.within(lat=lat, lon=lon)
 
+#
+# The table of locations geocoded ahead of time by geocodebatch.py, one
+# tab-separated line per location:
+#   id  location  latitude  longitude  region
+# location is as it appears in the dataset (whitespace normalized), and
+# region is the SFBounds name, or empty if outside them. A location The
+# Google had no answer for has empty latitude and longitude, so that it is
+# not paid for again either.
+#
+class GeocodeTable :
+
+  @staticmethod
+  def formatRow(locationId, location, geoinfo) :
+    if (geoinfo.get('latitude') is None) :
+      return "%d\t%s\t\t\t\n"%(locationId, location)
+    return "%d\t%s\t%.7f\t%.7f\t%s\n"%(locationId, location,
+                                       geoinfo['latitude'], geoinfo['longitude'],
+                                       geoinfo.get('name') or "")
+
+  # Returns (id, location, geoLookup result) for each row in the file at
+  # path. A torn last line (from a killed job) is skipped
+  @staticmethod
+  def rows(path) :
+    try:
+      infile = open(path, "r")
+    except IOError as e:
+      INFOPRINT("No geocode table %s: %s"%(path, str(e)), 1)
+      return
+    with infile :
+      for line in infile :
+        fields = line.rstrip("\n").split("\t")
+        if (len(fields) != 5 or not line.endswith("\n")) :
+          continue
+        geoinfo = dict()
+        if (fields[2]) :
+          geoinfo['latitude'] = float(fields[2])
+          geoinfo['longitude'] = float(fields[3])
+          geoinfo['name'] = fields[4] or None
+        yield int(fields[0]), fields[1], geoinfo
+
+  # Returns a dict of geoLookup results, keyed by GoogleMapInterface.locationKey
+  @staticmethod
+  def load(path) :
+    retval = dict()
+    for locationId, location, geoinfo in GeocodeTable.rows(path) :
+      retval[GoogleMapInterface.locationKey(location, False)] = geoinfo
+    return retval
+
+
+# Geocodes locationString (a location key) again for a stale cache entry
+# (see LRUCache.scheduleRefresh). Module level, so that it can go on the
+# task queue
+def refreshGeocode(locationString) :
+  gmi = GoogleMapInterface()
+  GoogleMapInterface.flights.do(locationString, gmi.fetchGeocode, locationString)
+
+
 #
 #
 # The Google Map Geolocation interface itself. Note that we do not 
@@ -103,12 +164,163 @@ class GoogleMapInterface :
   # one result) will be cahced for a much shorter period of time.
   # Items in the cache will go away after 10 days
   # ExpiringCaches are threadsafe
-  cache = ExpiringCache(864000)
+  # When full, the entries closest to expiring (the uncertain ones, most
+  # likely) make room first.
+  # Places don't move, so expired entries are served for up to another 10
+  # days while they are looked up again, or for as long as Google is failing
+  cache = ExpiringCache(864000, maxsize=20000, staleSeconds=864000)
+  # Geocode calls in progress, by location
+  flights = SingleFlight()
+  # Second tier behind the cache (a DatastoreStore, or a LogStore outside
+  # the App Engine), so that what was paid for survives a restart, and is
+  # shared by every instance. None until useStore is called
+  store = None
+  # Locations geocoded offline, by key (see useTable)
+  table = dict()
+  # Location keys of the locations in the dataset (see useAliases)
+  aliases = dict()
+  # Abbreviations spelled out by canonicalize ("st" is special)
+  abbreviations = { "ave" : "avenue", "av" : "avenue", "blvd" : "boulevard",
+                    "hwy" : "highway", "ln" : "lane", "pl" : "place",
+                    "sq" : "square", "ter" : "terrace", "ctr" : "center",
+                    "mt" : "mount", "ft" : "fort", "bet" : "between",
+                    "btwn" : "between", "@" : "at" }
+  # Words that can come right after a street name
+  streetEnders = ( "and", "at", "between", "from", "to", "near", "off" )
+  # Every call to The Google goes through here: at most 10 a second, and
+  # 2500 a day (the free quota). A call that would have to wait more than
+  # 2 seconds for its turn is not made.
+  # The 10 a second is per instance. The 2500 a day is for all instances
+  # together on the App Engine, where it is counted in memcache; anywhere
+  # else (or if memcache loses the count) it too is per instance, and the
+  # real ceiling is 2500 times the number of instances
+  limiter = RateLimiter(10, dailyBudget=2500, maxWait=2, sharedBudgetKey="geocode")
+  # How many times to try again when The Google says we are over the limit
+  quotaRetries = 3
+  # How many geocode calls geoLookupMany makes at once
+  lookupThreads = 8
+  # Where geocode requests go. May be pointed at a stand-in for testing
+  geocodeUrl = "https://maps.googleapis.com/maps/api/geocode/json"
 
   def __init__(self) :
     self.decoder = json.JSONDecoder()
     pass
 
+  # Keeps every geocode result in store as well, and looks there before
+  # paying for a geocode. Preloads the cache with whatever store has to
+  # preload (see LogStore and DatastoreStore).
+  # Returns the number of results preloaded
+  @staticmethod
+  def useStore(store) :
+    store.load()
+    retval = store.preload(GoogleMapInterface.cache)
+    GoogleMapInterface.store = store
+    return retval
+
+  # The cache (and store) key for a location: "Pier 39 " and "pier  39"
+  # cost one lookup between them, not two
+  @staticmethod
+  def normalize(locationString) :
+    return " ".join(locationString.split()).lower()
+
+  # Loads the location table written by the offline geocoding job
+  # (geocodebatch.py), which geoLookup consults before anything else.
+  # Returns the number of locations in it
+  @staticmethod
+  def useTable(path) :
+    GoogleMapInterface.table = GeocodeTable.load(path)
+    return len(GoogleMapInterface.table)
+
+  # The key a location is cached (and stored, and tabled) under: decoded,
+  # canonicalized, with SF, CA tacked on (if needed), and encoded back up.
+  # Locations in the dataset have theirs worked out ahead of time (see
+  # useAliases). With canonical False, only the case and whitespace are
+  # normalized, as it used to be
+  # Note that we have to tack on SF so that The Google doesn't return results
+  # in Costa Rica
+  @staticmethod
+  def locationKey(locationString, urlencoded=True, canonical=True) :
+    if (urlencoded) :
+      locationString = UrlEncoder.decode(locationString)
+    if (not canonical) :
+      return GoogleMapInterface.encodeKey(GoogleMapInterface.normalize(locationString))
+    retval = GoogleMapInterface.aliases.get(locationString)
+    if (retval is None) :
+      retval = GoogleMapInterface.encodeKey(GoogleMapInterface.canonicalize(locationString))
+    return retval
+
+  @staticmethod
+  def encodeKey(locationString) :
+    # Having "SF, CA" and "San Francisco, CA", etc. does not seem to hurt The Google's
+    # results, and actually seems to help it somewhat.
+    if (not re.search(r"san francisco,?\s+ca", locationString, re.I)) :
+      locationString += " san francisco, ca"
+    return UrlEncoder.encode(locationString)
+
+  # Spells a location out one way only, so that "Filbert St. & Kearny St."
+  # and "filbert street and kearny street" cost one lookup between them,
+  # not two: case and whitespace are normalized, "&" is "and", periods go,
+  # and the usual street abbreviations are spelled out.
+  # "St" is "street" at the end of a name ("Market St", "Market St,",
+  # "Market St and ...", "Market St (...)"), and "saint" at the start of
+  # one ("St. Mary's Cathedral")
+  @staticmethod
+  def canonicalize(locationString) :
+    locationString = GoogleMapInterface.normalize(locationString.replace("&", " and ").replace(".", " "))
+    locationString = re.sub(r"\s*,\s*", ", ", locationString)
+    locationString = re.sub(r"\s+\)", ")", re.sub(r"\(\s+", "(", locationString))
+    words = locationString.split()
+    for i, word in enumerate(words) :
+      core = word.strip("(),")
+      if (core == "st") :
+        following = words[i + 1] if i + 1 < len(words) else None
+        if (following is None or word[-1] in ",)" or following[0] == "("
+            or following in GoogleMapInterface.streetEnders) :
+          core = "street"
+        else :
+          core = "saint"
+      else :
+        core = GoogleMapInterface.abbreviations.get(core)
+        if (core is None) :
+          continue
+      words[i] = word.replace(word.strip("(),"), core, 1)
+    return " ".join(words)
+
+  # Works out the location keys of every location in the dataset, so that
+  # geoLookup on any of them need not, and so that variants of one place
+  # share a key: a location with a parenthetical at the end ("Coit Tower
+  # (Telegraph Hill)") gets the key of the location without it, if the
+  # dataset has that one as well, or if it has other variants of it
+  # ("Coit Tower (Pioneer Park)"). Otherwise the parenthetical is kept,
+  # as it is often the only address there is ("Epic Roasthouse (399
+  # Embarcadero)").
+  # Returns a dict of location (utf-8) to key
+  @staticmethod
+  def buildAliases(locations) :
+    canonical = dict()
+    variants = dict()
+    for location in locations :
+      if (isinstance(location, unicode)) :
+        location = location.encode("utf-8")
+      form = canonical[location] = GoogleMapInterface.canonicalize(location)
+      base = re.sub(r"\s*\([^()]*\)$", "", form)
+      variants.setdefault(base, set()).add(form)
+    retval = dict()
+    for location, form in canonical.iteritems() :
+      base = re.sub(r"\s*\([^()]*\)$", "", form)
+      if (base and (base in variants[base] or len(variants[base]) > 1)) :
+        form = base
+      retval[location] = GoogleMapInterface.encodeKey(form)
+    return retval
+
+  # Sets the location aliases (see buildAliases) from the locations in the
+  # dataset. Returns the number of distinct keys they come down to
+  @staticmethod
+  def useAliases(locations) :
+    aliases = GoogleMapInterface.buildAliases(locations)
+    GoogleMapInterface.aliases = aliases
+    return len(set(aliases.itervalues()))
+
   # Returns a dict of:
   # latitude: floating point
   # longitude: floating point
@@ -118,78 +330,181 @@ class GoogleMapInterface :
   def geoLookup(self, locationString, urlencoded=True) :
     if locationString is None:
       return None
-    locationString = str(locationString)
-
-    # Url decode our string, tack on SF, CA (if needed), and encode back up
-    # Note that we have to tack on SF so that The Google doesn't return results
-    # in Costa Rica
-    if (urlencoded) :
-      locationString = UrlEncoder.decode(locationString)
-    # Having "SF, CA" and "San Francisco, CA", etc. does not seem to hurt The Google's
-    # results, and actually seems to help it somewhat.
-    if (not re.search(r"san francisco,?\s+ca", locationString, re.I)) :
-      locationString += " San Francisco, CA"
-    locationString = UrlEncoder.encode(locationString)
+    locationString = GoogleMapInterface.locationKey(str(locationString), urlencoded)
+    # A known location may have no coordinates ({}): it was looked up,
+    # and is not to be found. No point paying to find that out again
+    retval = self.knownLookup(locationString)
+    if (retval is not None) :
+      return retval
 
-    # Do a cache lookup first
-    retval = GoogleMapInterface.cache.get(locationString)
-    if (retval) :
+    # Every call costs money, so never make the same one twice at once
+    return GoogleMapInterface.flights.do(locationString, self.fetchGeocode, locationString)
+
+  # geoLookup for a whole list of locations (None for none), such as all
+  # the filming locations of a title. Returns the list of results, in the
+  # same order.
+  # Each distinct location is only looked up once, and the ones that have
+  # to go to The Google are looked up at the same time, at most
+  # lookupThreads at once, so that the whole list takes about as long as
+  # the slowest of them, and not all of them put together.
+  # Stale cache entries are used as they are (see LRUCache.get)
+  def geoLookupMany(self, locationStrings, urlencoded=True) :
+    keys = [GoogleMapInterface.locationKey(str(locationString), urlencoded)
+            if locationString is not None else None
+            for locationString in locationStrings]
+    results = dict()
+    misses = Queue.Queue()
+    for key in keys :
+      if (key is None or key in results) :
+        continue
+      results[key] = self.knownLookup(key)
+      if (results[key] is None) :
+        misses.put(key)
+
+    def worker() :
+      while True :
+        try:
+          key = misses.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          results[key] = GoogleMapInterface.flights.do(key, self.fetchGeocode, key)
+        except Exception as e:
+          results[key] = { 'errmsg' : str(e) }
+
+    threads = [Thread(target=worker) for i in range(min(misses.qsize(), GoogleMapInterface.lookupThreads))]
+    for thread in threads :
+      thread.start()
+    for thread in threads :
+      thread.join()
+    return [results.get(key) for key in keys]
+
+  # The part of geoLookup that costs nothing: the table, then the cache.
+  # A stale cache entry is good enough for now: it is queued to be looked
+  # up again (see LRUCache.get). Returns None if the location is in neither
+  def knownLookup(self, locationString) :
+    # Locations geocoded ahead of time cost nothing
+    retval = GoogleMapInterface.table.get(locationString)
+    if (retval is not None) :
       return retval
+    refresh = functools.partial(refreshGeocode, locationString)
+    return GoogleMapInterface.cache.get(locationString, refresh)
+
+  # Does the actual geocode call for geoLookup, and caches the result.
+  # locationString is already url encoded
+  def fetchGeocode(self, locationString) :
+    # Whoever was fetching it before us may have just finished
+    if (locationString in GoogleMapInterface.cache) :
+      retval = GoogleMapInterface.cache.get(locationString)
+      if (retval is not None) :
+        return retval
+
+    # Paid for before: by another instance, or before a restart
+    store = GoogleMapInterface.store
+    if (store is not None) :
+      stored = store.get(locationString)
+      if (stored is not None) :
+        retval, expiretime = stored
+        GoogleMapInterface.cache.put(locationString, retval,
+                                     ttlSeconds=Default if expiretime is None else expiretime - time.time())
+        return retval
 
     # We have to switch over to the secure/paid version of the API, as I keep running up against my quota
-    url = ("https://maps.googleapis.com/maps/api/geocode/json?address=%s"%locationString) + "&key=" + GOOGLE_API_KEY
-    try:
-      # It is suggested to wait a little more than multiples of 3 seconds, so
-      # as not to conflict with an internal TCP timer
-      # Due to a bug in the Google API engine, URLLib3 does NOT support HTTPS correctly
-      # Thus, back off to using urllib
-      #response = requests.get(url, timeout=(6.05, 22))
-      # code = response.status_code
-      # content = response.content
-      # Urllib2
-      #conn = urllib.urlopen(url)
-      #code = conn.getcode()
-      #content = conn.read()
-      # urlfetch
-      # I am PAYING to use urlfetch, I will use the defualt timeout values that Google has set up: they know best.
-      conn = urlfetch.fetch(url)
-      code = conn.status_code
-      content = conn.content
-    except Exception as e:
-      return { 'errmsg' : str(e) }
-    if (code < 200 or code >= 300) :
-      INFOPRINT("Error code %d from url \"%s\""%(code))
-      return { 'errmsg' : "GoogleMaps request failed" }
-    dic = self.decoder.decode(content)
+    url = (GoogleMapInterface.geocodeUrl + "?address=%s"%locationString) + "&key=" + GOOGLE_API_KEY
+    limiter = GoogleMapInterface.limiter
+    attempt = 0
+    while True :
+    #{
+      # Over budget (or too busy to wait our turn): no marker this time,
+      # which is better than no markers at all once the quota is gone
+      if (not limiter.acquire()) :
+        return { 'errmsg' : "Geocode quota used up, try again later" }
+      try:
+        # It is suggested to wait a little more than multiples of 3 seconds, so
+        # as not to conflict with an internal TCP timer
+        # Due to a bug in the Google API engine, URLLib3 does NOT support HTTPS correctly
+        # Thus, back off to using urllib
+        #response = requests.get(url, timeout=(6.05, 22))
+        # code = response.status_code
+        # content = response.content
+        # Urllib2
+        #conn = urllib.urlopen(url)
+        #code = conn.getcode()
+        #content = conn.read()
+        # urlfetch
+        # I am PAYING to use urlfetch, I will use the defualt timeout values that Google has set up: they know best.
+        conn = urlfetch.fetch(url)
+        code = conn.status_code
+        content = conn.content
+      except Exception as e:
+        return { 'errmsg' : str(e) }
+      if (code < 200 or code >= 300) :
+        INFOPRINT("Error code %d from url \"%s\""%(code, url))
+        return { 'errmsg' : "GoogleMaps request failed" }
+      try:
+        dic = self.decoder.decode(content)
+      except Exception as e:
+        return { 'errmsg' : str(e) }
+      if (dic.get('status') != "OVER_QUERY_LIMIT") :
+        break
+      # Going too fast for The Google. Everyone backs off for a while, and
+      # we try again, up to a point
+      delay = limiter.backoff(attempt)
+      limiter.quotaError(delay)
+      MUSTPRINT("Geocode over query limit, attempt %d, backing off %.2f seconds"%(attempt, delay))
+      if (attempt >= GoogleMapInterface.quotaRetries) :
+        return { 'errmsg' : "Geocode quota exceeded, try again later" }
+      attempt += 1
+      limiter.retried()
+    #}
     try:
-      resultList = dic['results']
-      retval = dict()
-      if (resultList) :
-        # If this isn't here, we will throw an exception and the request will fail.
-        lat = resultList[0]['geometry']['location']['lat']
-        lon = resultList[0]['geometry']['location']['lng']
-        name = SFBounds.within(lat=lat, lon=lon)
-        retval['latitude'] = lat
-        retval['longitude'] = lon
-        retval['name'] = name
-      # If only one entry, then assume that we've got a pretty good result.
-      # So just leave it be, let it be
-      if dic.get('error_message') :
-        retval['errmsg'] = dic.get('error_message')
-      else :
-        if (len(resultList) == 1) :
-          # If only one result, then cache for the default (10 days)
-          ttl = None
-        else :
-          # Otherwise, only let the result be cached for a day, as there are
-          # apparently many different entries possible for this guy
-          ttl = 86400
-        GoogleMapInterface.cache.put(locationString, retval, ttlSeconds=ttl)
-      return retval
+      retval, ttl = GoogleMapInterface.parseGeocode(dic)
     except Exception as e:
       INFOPRINT("GEO LOOKUP EXCEPTION! = %s"%str(e), 5)
       # Leave the cache alone
       return { 'errmsg' : str(e) }
+    if (retval.get('errmsg')) :
+      return retval
+    GoogleMapInterface.cache.put(locationString, retval, ttlSeconds=ttl)
+    if (GoogleMapInterface.store is not None) :
+      if (ttl is None) :
+        ttl = GoogleMapInterface.cache.defaultExp
+      GoogleMapInterface.store.put(locationString, retval, time.time() + ttl)
+    return retval
+
+  # Turns a decoded geocode response into a geoLookup result, and returns
+  # it along with how long it may be cached for: None (the default, 10
+  # days) if there was a single result, a day if there was more than one.
+  # Results that must not be cached at all have an "errmsg"
+  @staticmethod
+  def parseGeocode(dic) :
+    # Only OK and ZERO_RESULTS are answers. Anything else (UNKNOWN_ERROR,
+    # INVALID_REQUEST, REQUEST_DENIED...) says nothing about the location,
+    # so it must not be kept as "not to be found"
+    status = dic.get('status', "OK")
+    if (status not in ("OK", "ZERO_RESULTS")) :
+      return { 'errmsg' : dic.get('error_message') or "Geocode failed: %s"%status }, 0
+    resultList = dic['results']
+    retval = dict()
+    if (resultList) :
+      # If this isn't here, we will throw an exception and the request will fail.
+      lat = resultList[0]['geometry']['location']['lat']
+      lon = resultList[0]['geometry']['location']['lng']
+      name = SFBounds.within(lat=lat, lon=lon)
+      retval['latitude'] = lat
+      retval['longitude'] = lon
+      retval['name'] = name
+    # If only one entry, then assume that we've got a pretty good result.
+    # So just leave it be, let it be
+    if dic.get('error_message') :
+      retval['errmsg'] = dic.get('error_message')
+      return retval, 0
+    if (len(resultList) == 1) :
+      # If only one result, then cache for the default (10 days)
+      return retval, None
+    # Otherwise, only let the result be cached for a day, as there are
+    # apparently many different entries possible for this guy
+    return retval, 86400
 
 
   @staticmethod
@@ -201,7 +516,8 @@ class GoogleMapInterface :
   #    various link clicks,
   # infoWIndowTitle, which will be what will be in the popup info window. Can be unset
   # infoWIndowUP, which contains the name of the marker that the info window will be
-  # stuck on. This is typically used for single-marker searches only
+  # stuck on. This is typically used for single-marker searches only. With no
+  # markers at all, the info window goes in the middle of the map
   #
   # Returns a list of strings that should be output'd to create the necessary map
   # Taken pretty much verbatim from:
@@ -322,6 +638,13 @@ class GoogleMapInterface :
         "infowindow.setContent('%s');"%infoWindowTitle,
         "infowindow.open(locationmap,%s);"%infoWindowUp
       ])
+    elif (infoWindowTitle and not listOfMarkers) :
+      # No marker to hang it on: put it in the middle of the map
+      outlist.extend([
+        "infowindow.setContent('%s');"%infoWindowTitle,
+        "infowindow.setPosition(centerpoint);",
+        "infowindow.open(locationmap);"
+      ])
 
     outlist.extend([
       "}", # End initialize
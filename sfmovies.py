@@ -21,6 +21,9 @@ from BaseImport import *
 
 # This is the Google App Engine API
 import webapp2
+# Stale cache entries are refreshed by deferred tasks (see
+# LRUCache.scheduleRefresh)
+from google.appengine.ext import deferred
 
 # Url and JSON encoders/decoders (we don't use urllib for communication)
 import urllib, json
@@ -80,16 +83,67 @@ metadataurl = baseurl
 # metadata).
 rowsurl=baseurl+"/rows.json"
 
-# This needs to be done once on startup, and then done repeated on a separate
-# thread. Initial load done now, but separate thread not yet done (if I ever do that,
-# that is a feature to drop)
-# Note that time limitations and inability to properly test changes
-# in the data and metadata (hasn't happened since I started writing this)
-# make backend re-scraping ill-advised at this time
+# This needs to be done once on startup, and then again every so often:
+# cron (see cron.yaml) asks for cmd=refresh, which polls the metadata, and
+# only re-scrapes (and then only applies the rows that changed) when the
+# dataset version moves
+
+# To keep from paying for the full fetch and tree build on every instance
+# start, the built table is kept in a snapshot file (which may be shipped
+# with the app). We only go to the SFMovie database if there is none.
+# However old it is, it is used: the snapshot knows its dataset version,
+# and the refresher brings it up to date from there, applying only the
+# rows that changed. Only a table that was actually fetched is saved, lest
+# an empty one be loaded from then on.
+# Cron reaches only one instance, and the App Engine cannot write the
+# snapshot back, so every instance brings its own table up to date at
+# warmup, if it was last checked more than snapshotmaxage ago. Never in a
+# user request: that would be the wait the snapshot is there to save. An
+# instance started by a user request (which gets no warmup) stays at the
+# snapshot's version until cron happens to reach it
+snapshotfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "autocomplete.snapshot")
+snapshotmaxage = 3600
 
 actable = AutocompleteTable(sitename, datasetname)
-actable.fetchAutocomplete()
-printInterval("Fill Autocomplete Table")
+refresher = AutocompleteRefresher(actable, metadataurl, snapshotfile)
+if (actable.loadSnapshot(snapshotfile)) :
+  printInterval("Load Autocomplete Snapshot")
+elif (actable.fetchAutocomplete(refresher.fetchVersion())) :
+  printInterval("Fill Autocomplete Table")
+  actable.saveSnapshot(snapshotfile)
+
+# Title, location, actor and director searches are answered from a local
+# copy of the dataset, kept at the same version as the autocomplete table.
+# Loading it is a full, paged fetch of the dataset, so it is not done here
+# (that would undo the quick start from the snapshot), but by the warmup
+# request and by cmd=refresh. Until it has loaded, searches go to SODA
+mirror = DatasetMirror()
+def refreshMirror() :
+  if (mirror.version != actable.dataset['version'] or not mirror.loaded()) :
+    start = time.time()
+    if (mirror.load(SoQLInterface(sitename, datasetname), actable.dataset['version'])) :
+      SoQLInterface.mirror = mirror
+      MUSTPRINT("Loaded dataset mirror in %.1f seconds"%(time.time() - start))
+
+# Variant spellings of the same location share one geocode (see
+# GoogleMapInterface.buildAliases). Worked out again when the dataset changes
+aliased = GoogleMapInterface.useAliases(actable.locations())
+printInterval("Alias %d Locations"%aliased)
+
+# Geocode results are paid for, so they are kept in the Datastore as well
+# (the App Engine filesystem is read only), shared by every instance.
+# Outside the App Engine, they are kept on disk instead, and preloaded into
+# the geocode cache here
+if (DatastoreStore.available()) :
+  geocodestore = DatastoreStore("geocode")
+else :
+  geocodestore = LogStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode.log"))
+preloaded = GoogleMapInterface.useStore(geocodestore)
+printInterval("Preload %d Geocode Results"%preloaded)
+# Locations geocoded ahead of time by geocodebatch.py, shipped with the app
+geocodetable = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode.table")
+tabled = GoogleMapInterface.useTable(geocodetable)
+printInterval("Load %d Geocoded Locations"%tabled)
 
 # Now run the autotests on startup
 from autotest import Autotests
@@ -102,20 +156,17 @@ Autotests.perform(
 #### Main page class ####
 class MainPage(webapp2.RequestHandler):
 
-  # MY LRUCaches are threadsafe, so we can make them static
-  urlCache = LRUCache(maxsize=100)
+  # MY LRUCaches are threadsafe, so we can make them static.
+  # Every request looks in here first, so it is split into separately
+  # locked segments, lest the request threads all line up on one lock
+  urlCache = ShardedCache(8, maxsize=128)
 
-  # There may be a *LOT* of autocomplete queries, so store them in their own cache.
-  # Because they need to be fast, use a simple cache (which prevents synchronization
-  # by providing no real value over a normal dict). We will rely on an outside agent
-  # to invalidate the cache when the metadata has changed
+  # There may be a *LOT* of autocomplete queries, so they do not go in the URL
+  # cache at all. The AutocompleteTable keeps its own response cache, keyed on
+  # the query rather than the whole URL, bounded by memory, and able to answer
+  # "vert" from the cached answer for "ver". It is thrown out along with the
+  # dataset whenever the dataset is refreshed
   #
-  # Repeat: impossible to test, since metadata has not changed, so for this 
-  # challenge (only), this will not be performed. Note that simply restarting the server
-  # once a day gets us this effect.
-  #
-  autccompleteCache = SimpleCache()
-
   def __init__(self, request=None, response=None) :
     global datasetname
     global sitename
@@ -136,15 +187,15 @@ class MainPage(webapp2.RequestHandler):
       path = self.request.path
       queries = self.request.query_string
       command = self.request.get('cmd').lower()
-      # Be sure to use the correct cache!
-      if (command == "query") :
-        cache = MainPage.autocompleteCache
+      # Be sure to use the correct cache! Autocomplete has its own
+      if (self.request.get('query')) :
+        cache = None
       else :
         cache = MainPage.urlCache
       key = UrlEncoder.decode("%s?%s"%(path,queries))
 
       # Now look the item up in the correct cache
-      result = cache.get(key)
+      result = cache.get(key) if cache is not None else None
       if not result :
         INFOPRINT("CACHE MISS ON \"%s\""%key,2)
         # Call the internal worker function to actually do the work
@@ -157,9 +208,15 @@ class MainPage(webapp2.RequestHandler):
         if (result is None) :
           return
 
-        # Now cache the result, but ONLY if there was no error message!
+        # Now cache the result, but ONLY if there was no error message,
+        # and nothing is missing from it
         errmsg = result.get('errmsg')
-        if (not errmsg) :
+        if (cache is None) :
+          # Autocomplete, already cached by the AutocompleteTable
+          pass
+        elif (result.get('degraded')) :
+          INFOPRINT("Not caching incomplete %s search"%command, 5)
+        elif (not errmsg) :
           INFOPRINT("Storing \"%s\" in cache"%key, 2)
           cache.put(key, result)
         else :
@@ -211,15 +268,41 @@ class MainPage(webapp2.RequestHandler):
       inp = query
       self.response.headers['Content-Type'] = 'application/json'
       if (ISLEVEL(1)) :  INFOPRINT("AUTOCOMPLETE, GOT QUERY \"%s\""%inp,1)
-      holder = DictHolder()
-      # Pass by ref to speed up the lookup as much as possible
-      responseDict = holder.dictObj
-      self.doAutocomplete(inp, holder)
-      string = json.dumps(holder.dictObj)
+      # Optional cap on the number of suggestions. The lookup stops walking
+      # the tree once it has this many
+      limit = self.request.get('limit')
+      try :
+        limit = int(limit) if limit else None
+      except ValueError :
+        limit = None
+      # No such thing as zero (or fewer) suggestions: same as no cap
+      if (limit is not None and limit <= 0) :
+        limit = None
+      # Optional typo tolerance: the number of typos (1 or 2) to allow
+      fuzzy = self.request.get('fuzzy')
+      try :
+        fuzzy = int(fuzzy) if fuzzy else 0
+      except ValueError :
+        fuzzy = 0
+      # Optional suggestion order: "weight" (most popular first, the default)
+      # or "name" (alphabetical)
+      order = self.request.get('order')
+      if (order != AutocompleteTable.byName) :
+        order = AutocompleteTable.byWeight
+      # Short queries were answered when the dataset was built
+      string = None
+      if (limit is None and not fuzzy and order == AutocompleteTable.byWeight) :
+        string = actable.getPrecomputed(inp)
+      if (string is None) :
+        holder = DictHolder()
+        # Pass by ref to speed up the lookup as much as possible
+        responseDict = holder.dictObj
+        self.doAutocomplete(inp, holder, limit, fuzzy, order)
+        string = json.dumps(holder.dictObj)
       result = dict()
       result['body'] = [string]
       result['headers'] = self.response.headers
-      # This WILL get cached
+      # This WON'T get cached here: the AutocompleteTable caches the lookup
       return result
 
     # All other commands take an optional "input" parameter
@@ -234,11 +317,18 @@ class MainPage(webapp2.RequestHandler):
       outputlist.extend([
         'COMMANDS',
         '/?cmd=start: initialize the server',
+        '/?cmd=refresh: (cron only) check the dataset metadata now, update the autocomplete table if it changed, and load the dataset mirror if it is not',
         '/?cmd=help: this message',
+        '/?cmd=stats: hit, miss, eviction and expiration counts of the caches, and coalesced upstream calls',
         '/?cmd=debug&input=<number>: set debug level to integer number. 0 means off',
         '/?cmd=ts&input=<name>: do a search of filming locations for given title',
         '/?cmd=ls&input=<name>: do a search of films made at a given title',
+        '/?cmd=as&input=<name>: do a search of filming locations of every film with a given actor',
+        '/?cmd=ds&input=<name>: do a search of filming locations of every film by a given director',
         '/?query=<input>: do an autocomplete search from the autocomplete database',
+        '/?query=<input>&limit=<number>: autocomplete search returning at most number suggestions',
+        '/?query=<input>&fuzzy=<number>: autocomplete search also allowing up to number (1 or 2) typos',
+        '/?query=<input>&order=name: autocomplete search in alphabetical rather than popularity order',
         '/: show the welcome (initial) screen'
        ])
       # Do our own printout so that people will not cache this one (in case something changes based
@@ -262,6 +352,48 @@ class MainPage(webapp2.RequestHandler):
       return None
 
 
+    # Check the metadata right now. This is what cron calls (see cron.yaml),
+    # as background threads may not outlive a request.
+    # Only cron may: the App Engine strips X-Appengine-Cron from requests
+    # from outside, so no one else can send it
+    if (command == "refresh") :
+      if (self.request.headers.get('X-Appengine-Cron') != "true") :
+        self.response.set_status(403)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write("cmd=refresh is for cron only")
+        return None
+      responseDict = dict()
+      self.response.headers['Content-Type'] = 'application/json'
+      responseDict['result'] = "changed" if refresher.refresh() else "unchanged"
+      responseDict['version'] = actable.dataset['version']
+      # Loads the mirror if it has not been, or is behind the table
+      refreshMirror()
+      responseDict['mirror'] = mirror.loaded()
+      # Do our own printout so that people will not cache this one
+      self.response.write(json.dumps(responseDict))
+      return None
+
+    # Hit, miss, eviction and expiration counts of all our caches
+    if (command == "stats") :
+      responseDict = dict()
+      self.response.headers['Content-Type'] = 'application/json'
+      responseDict['urlCache'] = MainPage.urlCache.stats()
+      responseDict['autocompleteCache'] = actable.dataset['responseCache'].stats()
+      responseDict['soqlCache'] = SoQLInterface.cache.stats()
+      # Connections made, and where the time goes, per SODA request
+      responseDict['soqlTransport'] = SoQLInterface.transport.stats()
+      responseDict['mirror'] = mirror.stats()
+      responseDict['geocodeCache'] = GoogleMapInterface.cache.stats()
+      responseDict['geocodeStore'] = GoogleMapInterface.store.stats()
+      # Geocode calls made (and shed) per day
+      responseDict['geocodeQuota'] = GoogleMapInterface.limiter.stats()
+      # Upstream calls made, and saved by joining one already in progress
+      responseDict['soqlFlights'] = SoQLInterface.flights.stats()
+      responseDict['geocodeFlights'] = GoogleMapInterface.flights.stats()
+      # Do our own printout so that people will not cache this one
+      self.response.write(json.dumps(responseDict))
+      return None
+
     # Set debug level
     if (command == "debug") :
       inputint = int(inp)
@@ -284,12 +416,13 @@ class MainPage(webapp2.RequestHandler):
       result['headers'] = self.response.headers
       return result
 
-    # Title Search
-    elif (command == "ts"):
+    # Title, actor or director Search: all of them map filming locations
+    elif (command in MainPage.markerSearches):
       result = dict()
-      errorString = self.illegalInput(inp,"title")
+      searchType = MainPage.markerSearches[command]
+      errorString = self.illegalInput(inp,searchType)
       if not errorString :
-        bodyfail = self.doTitleSearch(inp)
+        bodyfail = self.doMarkerSearch(inp, searchType)
       # If an error was reported, bring up the welcome screen
       if (errorString or bodyfail.get('errmsg')) :
         if (not errorString) :
@@ -297,6 +430,7 @@ class MainPage(webapp2.RequestHandler):
         bodyfail = self.doWelcomeScreen(errorString)
       result['body'] = bodyfail.get('body')
       result['errmsg'] = bodyfail.get('errmsg')
+      result['degraded'] = bodyfail.get('degraded')
       result['headers'] = self.response.headers
       return result
 
@@ -371,18 +505,33 @@ class MainPage(webapp2.RequestHandler):
       href="<a href=\"/?cmd=ts&input=%s\">%s</a><br>"%(UrlEncoder.encode(t),title)
       infotitle += (href)
     # Even if the marker is outside of the city limits, show it anyway...
-    marker = gmi.geoLookup(inp, True)
+    # A copy: the result is shared with the geocode cache (and table)
+    marker = dict(gmi.geoLookup(inp, True) or {})
+    label = "Movies filmed at " + inp
+    # No coordinates: either the location could not be looked up right now
+    # (e.g. the geocode quota is used up), in which case the page still
+    # goes out, without the marker, but is not cached; or it is known not
+    # to be found, which is as good an answer as any
     errmsg = marker.get('errmsg')
-    marker['name'] = inp
+    degraded = bool(errmsg)
+    if ('latitude' in marker) :
+      marker['name'] = inp
+      markers = [marker]
+      infoup = "marker0"
+    else :
+      markers = []
+      infoup = None
+      label += " (%s)"%(errmsg if errmsg else "could not be mapped")
+      if (errmsg and ISLEVEL(1)) : INFOPRINT("No marker for '%s': %s"%(inp, errmsg),1)
     # And create the map
-    outlist.extend(GoogleMapInterface.mapHeader(title, [marker], 
+    outlist.extend(GoogleMapInterface.mapHeader(title, markers, 
                                                 searchCmd=None,
                                                 infowindowtitle=infotitle,
-                                                infoup="marker0"))
+                                                infoup=infoup))
     outlist.append("</head>");
     # Now do the body. This is pretty simple code
-    outlist.extend(self.generateBody(label="Movies filmed at " + inp))
-    return {'body' : outlist, 'errmsg' : errmsg}
+    outlist.extend(self.generateBody(label=label))
+    return {'body' : outlist, 'errmsg' : None, 'degraded' : degraded}
 
   # Welcome screen brings up a map of SF with no markers,
   # and puts up the message fron inp.
@@ -408,18 +557,32 @@ class MainPage(webapp2.RequestHandler):
     return { 'body' : outlist, 'errmsg' : errmsg }
 
 
+  # The search commands that put up a map of filming locations, and
+  # what they search for. The autocomplete suggestions use the same
+  # commands (see Fields.commands)
+  markerSearches = { "ts" : "title", "as" : "actor", "ds" : "director" }
+
   # Do title search: does a search from the SoQL interface,
   # And for each marker does a GeoLookup
   # Finally, it passes all those markers into the map function in the GoogleMapInterafce
   # and adds in a simple boxy
   def doTitleSearch(self, inp) :
+    return self.doMarkerSearch(inp, "title")
+
+  # Same as doTitleSearch, but for searchType "title", "actor" or "director"
+  def doMarkerSearch(self, inp, searchType) :
     self.response.headers['Content-Type'] = 'text/html'
-    resultList = self.si.doTitleSearch(inp)
+    if (searchType == "actor") :
+      resultList = self.si.doActorSearch(inp)
+    elif (searchType == "director") :
+      resultList = self.si.doDirectorSearch(inp)
+    else :
+      resultList = self.si.doTitleSearch(inp)
     if (not resultList) :
-      return self.doWelcomeScreen("Sorry, couldn't find title %s"%inp)
+      return self.doWelcomeScreen("Sorry, couldn't find %s %s"%(searchType, inp))
     if (resultList[0].get('error_code')) :
       tryAgainString = resultList[0].get('try_again')
-      return self.doWelcomeScreen("Sorry, couldn't find title %s: %s.%s"%(inp, 
+      return self.doWelcomeScreen("Sorry, couldn't find %s %s: %s.%s"%(searchType, inp, 
                                                              resultList[0].get('error_code'),
                                                              ("Please try again later" if tryAgainString else "")))
     outlist = ["<!DOCTYPE html>",
@@ -431,24 +594,31 @@ class MainPage(webapp2.RequestHandler):
     # Sometimes, brackets are a good thing
     slelems = list()
     markernum = 0
-    errmsg = None
-    for result in resultList :
+    # Set if any location could not be looked up right now (e.g. the
+    # geocode quota is used up). The page still goes out with the markers
+    # that could be, but is not cached
+    degraded = False
+    # Look all the locations up at once. Strange...a result without a
+    # location. Bad data! Those come back as None, and are skipped
+    geoinfos = gmi.geoLookupMany([result.get('locations') or None for result in resultList], False)
+    for result, geoinfo in zip(resultList, geoinfos) :
     #{
-      # Strange...a result without a location. Bad data!
-      if not result.get('locations') :
-        continue
-      geoinfo = gmi.geoLookup(result['locations'], False)
       # Prevent needless calculation of strings
-      if (ISLEVEL(1))  : INFOPRINT("geoinfo for '%s' = %s"%(result['locations'],str(geoinfo)),1)
+      if (ISLEVEL(1))  : INFOPRINT("geoinfo for '%s' = %s"%(result.get('locations'),str(geoinfo)),1)
       if (not geoinfo):
         # Not there!
         continue;
       else :
       #{
-        errmsg = geoinfo.get('errmsg')
-        if (geoinfo.get('name')) :
-          geoinfo['name'] = result['locations']
-          markerlist.append(geoinfo)
+        if (geoinfo.get('errmsg')) :
+          if (ISLEVEL(1)) : INFOPRINT("No marker for '%s': %s"%(result.get('locations'), geoinfo['errmsg']),1)
+          degraded = True
+        elif (geoinfo.get('name')) :
+          # geoinfo is shared with the cache (and with any other row at
+          # the same location), so the marker gets a copy
+          marker = dict(geoinfo)
+          marker['name'] = result['locations']
+          markerlist.append(marker)
           markernum += 1
         # If name is blank, then we are outside SF, so drop it
       #}
@@ -458,9 +628,12 @@ class MainPage(webapp2.RequestHandler):
                                                 searchCmd="ls"))
     outlist.append("</head>");
     # Now do the body. This is pretyt simple code, so we just duplicate it
-    outlist.extend(self.generateBody(label=inp + ": filming locations within San Francisco"))
+    label = inp + ": filming locations within San Francisco"
+    if (degraded) :
+      label += " (some could not be mapped right now)"
+    outlist.extend(self.generateBody(label=label))
     # If we got at least one result, then there was no failure
-    return {'body' : outlist, 'errmsg' : errmsg}
+    return {'body' : outlist, 'errmsg' : None, 'degraded' : degraded}
 
 
   # Generates all the nice nice Javascript and CSS headers that go in each page.
@@ -532,36 +705,15 @@ class MainPage(webapp2.RequestHandler):
   # Return a JSON object in the format expected by JQuery-autocomplete
   # returns by reference thru holder to prevent any nasty copy operations
   # imposed by Python (shoudl be small, but just to be safe)
-  def doAutocomplete(self, inp, holder) :
+  # If limit is set, no more than limit suggestions are returned
+  # If fuzzy is set, suggestions up to that many typos away are included
+  # order is AutocompleteTable.byWeight or AutocompleteTable.byName
+  def doAutocomplete(self, inp, holder, limit=None, fuzzy=0, order=AutocompleteTable.byWeight) :
     global actable
     if (not inp) :
-      matches = { 'title' : [], 'locations' : [] }
+      outputlist = list()
     else :
-      matches = actable.doAutocomplete(inp)
-    outputlist = list()
-    titles = matches['title']
-    locations = matches['locations']
-    # Prevent needless generation of strings
-    if (ISLEVEL(1)) : INFOPRINT("THERE ARE %d titles and %d locations"%(len(titles),len(locations)),1)
-    while len(titles) > 0 or len(locations) > 0 :
-    #{
-      title = None if not titles else titles[0]
-      location = None if not locations else locations[0]
-      record = dict()
-      if (title is None) :
-        record['value'] = locations.pop(0)
-        record['data'] = "ls"
-      elif (location is None) :
-        record['value'] = titles.pop(0)
-        record['data'] = "ts"
-      elif (location > title) :
-        record['value'] = titles.pop(0)
-        record['data'] = "ts"
-      else :
-        record['value'] = locations.pop(0)
-        record['data'] = "ls"
-      outputlist.append(record)
-    #}
+      outputlist = actable.getSuggestions(inp, limit, fuzzy, order)
     holder.dictObj['query'] = "Unit"
     holder.dictObj['suggestions'] = outputlist
         
@@ -569,7 +721,30 @@ class MainPage(webapp2.RequestHandler):
 
 
 
+# Cached responses are no good once the dataset changes
+refresher.addListener(MainPage.urlCache.clear)
+# The geocode table is keyed on the aliases, so both are redone together
+def realias() :
+  GoogleMapInterface.useAliases(actable.locations())
+  GoogleMapInterface.useTable(geocodetable)
+refresher.addListener(realias)
+
+# App Engine sends this before routing traffic to a new instance (see
+# inbound_services in app.yaml), so the slow startup work that would
+# otherwise hold up a user request goes here
+class Warmup(webapp2.RequestHandler):
+  def get(self) :
+    refresher.refreshIfOlder(snapshotmaxage)
+    refreshMirror()
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write("warm")
+
 ### And this is our link to the outside world!
+# Deferred tasks are run here rather than by the builtin deferred handler,
+# so that a refresh on a fresh instance finds the geocode store, table
+# and aliases set up (see app.yaml)
 application = webapp2.WSGIApplication([
     ('/', MainPage),
+    ('/_ah/warmup', Warmup),
+    ('/_ah/queue/deferred', deferred.TaskHandler),
 ], debug=False)
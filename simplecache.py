@@ -11,9 +11,26 @@
 from __future__ import print_function
 
 from BaseImport import *
-from threading import Semaphore
+from threading import Lock, Thread, Event
+from random import Random
 
-import urllib
+import urllib, json, heapq, itertools, hashlib
+# Only on the App Engine, for DatastoreStore
+try:
+  from google.appengine.ext import ndb
+except ImportError:
+  ndb = None
+# Only on the App Engine, for RateLimiter's shared daily budget
+try:
+  from google.appengine.api import memcache
+except ImportError:
+  memcache = None
+# Only on the App Engine, for refreshing stale entries (see LRUCache.get)
+try:
+  from google.appengine.ext import deferred
+  from google.appengine.api import taskqueue
+except ImportError:
+  deferred = None
 
 # Since our dataset is pretty small, there is no real need to make
 # the cache either LRU (functools.lru_cache) or self-clearing.
@@ -68,81 +85,241 @@ class SimpleCache(object) :
 # Thus, it should ONLY be used
 # EXTREMELLY sparingly. In our case, we will use it for caching the
 # HTTP queries from the client that we do not want to re-do
-# Heavily modified form of the basic online implementation:
-# (modified for readability and for "get/put" operators)
+# Originally a heavily modified form of the basic online implementation:
 # http://stackoverflow.com/questions/4443920/python-building-a-lru-cache
 #
 
+#
+# What a task queued by LRUCache.scheduleRefresh runs. A refresh that fails
+# is not tried again by the queue: the entry is still served stale, and the
+# next get after retrySeconds queues another
+#
+def runDeferredRefresh(refresh) :
+  try:
+    refresh()
+  except Exception as e:
+    INFOPRINT("Deferred cache refresh failed: %s"%str(e), 5)
+
+
+#
+# One entry of an LRUCache. Entries are the links of a circular doubly
+# linked list, newest to oldest. Slots keep them about as small as a
+# 4 element list would be, but with names instead of magic indexes.
+#
+# expiretime => time.time() after which the entry is no good, None for never
+# staleuntil => time.time() up to which the entry may still be served,
+#               stale, while it is being refreshed. None for no stale window
+# retryafter => time.time() before which a stale entry is not queued for
+#               refresh again: one is already queued or running, or the last
+#               one failed
+# size => the (approximate) size of the value in bytes, if the cache cares
+# validators => whatever the value's source needs to tell whether it has
+#               changed (say, HTTP ETag and Last-Modified), None if nothing
+#
+class CacheEntry(object) :
+  __slots__ = ('newer', 'older', 'key', 'value', 'expiretime', 'staleuntil',
+               'retryafter', 'size', 'validators')
+
+  def __init__(self, key=None, value=None, expiretime=None, staleuntil=None, size=0, validators=None) :
+    self.newer = self
+    self.older = self
+    self.key = key
+    self.value = value
+    self.expiretime = expiretime
+    self.staleuntil = staleuntil
+    self.retryafter = 0
+    self.size = size
+    self.validators = validators
+
+
+#
+# LRU cache with a time to live on each entry. get and put are O(1): the
+# entries are found through a dict, and kept in recency order in a linked
+# list whose root is a dummy entry: root.older is the newest entry, and
+# root.newer (going all the way around) is the oldest.
+#
+# Keyword arguments:
+# maxsize => the most entries to hold, None for no limit (default 1024)
+# maxbytes => the most bytes (as told to put) to hold, None for no limit
+# defaultTTL => seconds an entry lives unless put says otherwise,
+#               None for forever
+# staleSeconds => stale while revalidate window: for this many seconds
+#                 past its time to live, an entry is still handed to a get
+#                 that says how to refresh it, and the refresh is queued
+#                 (see get). None (the default) for no stale window
+# retrySeconds => how long to wait before refreshing a stale entry again,
+#                 after its refresh was queued, or failed (default 60)
+#
+# The counters (hits, misses, evictions to make room, expirations of
+# entries found too old, stale hits, refreshes queued, and refreshes that
+# failed) are only
+# touched while holding the lock, so they always agree with each other.
+# stats() hands back a copy of them.
+#
 class LRUCache (SimpleCache):
 
   def __init__(self, **kwargs):
     self.Parent = super(LRUCache,self)
     self.Parent.__init__()
 
-    maxsize = kwargs.get("maxsize")
-    if (not maxsize) :
-      maxsize = 1024
-
-    self.lock = Semaphore()
+    self.maxsize = kwargs.get("maxsize", 1024)
+    self.maxbytes = kwargs.get("maxbytes")
+    self.defaultTTL = kwargs.get("defaultTTL")
+    self.staleSeconds = kwargs.get("staleSeconds")
+    self.retrySeconds = kwargs.get("retrySeconds", 60)
+    self.lock = Lock()
+    self.resetNotThreadSafe()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self.staleHits = 0
+    self.refreshes = 0
+    self.failedRefreshes = 0
 
-    # Link structure: [NEWER, OLDER, KEY, VALUE]
-    # Cache entries are kept in a circular queue.
-    # Root.previous is the oldest (as it cycles back)
-    # Root.next is the newest
-    self.root = [None, None, None, None]
-    self.root[0] = self.root[1] = self.root
-    self.maxsize = maxsize
-
-  # Since get updates the cache in a very threadunfriendly way, we must
-  # synchronize here. In the absense of any Python 3.x decorations, we 
-  # must use a simple semaphore
-  def get(self, key):
+  # Returns the value for key, or None if it is not there or has expired.
+  # refresh, if given, is a function that brings key's entry up to date
+  # (by calling put). If the entry has expired but is within the stale
+  # window, its value is returned anyway, right away, and refresh is
+  # handed off to run outside the request (see scheduleRefresh): get never
+  # waits on the source.
+  # Only one refresh of an entry is queued every retrySeconds, so if its
+  # source is down, it is not asked again by every get in turn.
+  # Either way, no call through to SimpleCache: this is the hot path
+  def get(self, key, refresh=None):
+    stale = None
     try:
       # START CRITICAL SECTION
-      self.lock.acquire(True)
-      link = self.Parent.get(key)
-      if (not link) :
+      self.lock.acquire()
+      entry = self.cache.get(key)
+      if (entry is None) :
+        self.misses += 1
         return None
+      if (entry.expiretime is not None) :
+        now = time.time()
+        if (now >= entry.expiretime) :
+          if (entry.staleuntil is None or now >= entry.staleuntil) :
+            self.removeNotThreadSafe(entry)
+            self.expirations += 1
+            self.misses += 1
+            return None
+          # Stale. Without a way to refresh it, it's a miss, but leave it
+          # be: the caller will replace it, or it may yet be refreshed
+          if (refresh is None) :
+            self.misses += 1
+            return None
+          self.staleHits += 1
+          if (now >= entry.retryafter) :
+            entry.retryafter = now + self.retrySeconds
+            self.refreshes += 1
+            stale = entry
+      self.moveToNewestNotThreadSafe(entry)
+      self.hits += 1
+      value = entry.value
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+    if (stale is not None) :
+      self.scheduleRefresh(stale, refresh)
+    return value
 
-      newer = 0
-      older = 1
-
-      # Now remove ourselves from the chain
-      newerthanus, olderthanus, key, value = link
-      newerthanus[older] = olderthanus
-      olderthanus[newer] = newerthanus
-      
-      self.moveToNewestNotThreadSafe(link)
-      return value
+  # Starts refresh for a stale entry without waiting for it.
+  # On the App Engine, a thread started in a request does not outlive it,
+  # and the response is not sent until the handler returns, so the refresh
+  # goes on the task queue instead. The task is named for the key (and the
+  # retrySeconds window), so that any number of instances finding the
+  # entry stale queue it once between them. refresh must then be
+  # picklable: a module level function, or a functools.partial of one.
+  # The task runs on whichever instance the queue picks, so it is that
+  # instance's cache that is brought up to date (and any shared store
+  # behind it, which is what the geocode cache has).
+  # Elsewhere, it runs on a thread of its own
+  def scheduleRefresh(self, entry, refresh) :
+    if (deferred is None) :
+      thread = Thread(target=self.runRefresh, args=(entry, refresh))
+      thread.daemon = True
+      thread.start()
+      return
+    window = int(time.time() // max(self.retrySeconds, 1))
+    name = "refresh-%s-%d"%(hashlib.md5(str(entry.key)).hexdigest(), window)
+    try:
+      deferred.defer(runDeferredRefresh, refresh, _name=name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError) :
+      pass
+    except Exception as e:
+      INFOPRINT("Could not queue refresh of cache entry \"%s\": %s"%(str(entry.key), str(e)), 5)
 
-    # No except clause. If something bad happens, then yer toast
+  # Runs refresh for a stale entry. If refresh fails, or decides not to
+  # put a new value, the entry stays stale, and is not refreshed again for
+  # retrySeconds
+  def runRefresh(self, entry, refresh) :
+    try:
+      refresh()
+    except Exception as e:
+      INFOPRINT("Refresh of cache entry \"%s\" failed: %s"%(str(entry.key), str(e)), 5)
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      if (self.cache.get(entry.key) is entry) :
+        entry.retryafter = time.time() + self.retrySeconds
+        self.failedRefreshes += 1
     finally:
       self.lock.release()
     # END CRITICAL SECTION
 
-  def put(self, key, value) :
-    newer = 0
-    older = 1
+  # Returns (value, validators) for key even if it has expired, or None if
+  # it is not there (any more). For revalidating an expired value with its
+  # source rather than fetching it all over again. Does not count as a hit
+  # or miss, nor does it make the entry any newer
+  def peek(self, key) :
     try:
-      root = self.root
       # START CRITICAL SECTION
-      self.lock.acquire(True)
-      # Link structure: [PREV, NEXT, KEY, VALUE]
-      if len(self.cache) >= self.maxsize:
-        # This is rather strange looking: newer than root is oldest
-        oldest = root[newer]
-        self.removeNotThreadSafe(oldest)
-
-      # Now insert ourselves on the head of the queue
-      usedtobenewest = root[older]
-      newlink = [root, usedtobenewest, key, value]
-
-      usedtobenewest[newer] = newlink
-      self.Parent.put(key, newlink)
-      root[older] = newlink
-      
-    # No except clause: if this happens, then yer toast
+      self.lock.acquire()
+      entry = self.cache.get(key)
+      if (entry is None) :
+        return None
+      return entry.value, entry.validators
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
 
+  # ttlSeconds is how long the entry lives: None or Default for the
+  # cache's defaultTTL. 0 or less means don't cache it at all.
+  # size is the size of value in bytes, for caches with a maxbytes
+  # validators are kept with the value, for peek
+  def put(self, key, value, ttlSeconds=Default, size=0, validators=None) :
+    if (ttlSeconds is None or ttlSeconds is Default) :
+      ttlSeconds = self.defaultTTL
+    # This is a trick you can use to not put something in the cache
+    if (ttlSeconds is not None and ttlSeconds <= 0) :
+      return
+    # Something bigger than the whole cache would just empty it out
+    if (self.maxbytes is not None and size > self.maxbytes) :
+      return
+    now = time.time()
+    if (ttlSeconds is None) :
+      entry = CacheEntry(key, value, size=size, validators=validators)
+    else :
+      entry = CacheEntry(key, value, now + ttlSeconds,
+                         None if self.staleSeconds is None else now + ttlSeconds + self.staleSeconds,
+                         size, validators)
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      # Replacing an entry: take the old one out first
+      old = self.cache.get(key)
+      if (old is not None) :
+        self.removeNotThreadSafe(old)
+      self.expireNotThreadSafe(now)
+      while (self.cache and
+             ((self.maxsize is not None and len(self.cache) >= self.maxsize) or
+              (self.maxbytes is not None and self.bytes + size > self.maxbytes))) :
+        self.removeNotThreadSafe(self.victimNotThreadSafe())
+        self.evictions += 1
+      self.cache[key] = entry
+      self.bytes += size
+      self.moveToNewestNotThreadSafe(entry)
+      self.addedNotThreadSafe(entry)
     finally:
       self.lock.release()
     # END CRITICAL SECTION
@@ -150,167 +327,839 @@ class LRUCache (SimpleCache):
   def clear(self) :
     try:
       # START CRITICAL SECTION
-      self.lock.acquire(True)
-      self.Parent.clear()   
-      self.root[0] = self.root[1] = self.root
-    except:
-      pass
+      self.lock.acquire()
+      self.resetNotThreadSafe()
     finally:
       self.lock.release()
     # END CRITICAL SECTION
 
-  def dump(self) :
-    count = len(self.cache)
+  # Empties the cache. The counters are left alone
+  def resetNotThreadSafe(self) :
+    self.cache = dict()
+    self.root = CacheEntry()
+    self.bytes = 0
+
+  # The entry to throw out to make room: the least recently used
+  # (root.newer is the oldest)
+  def victimNotThreadSafe(self) :
+    return self.root.newer
+
+  # Called with each new entry once it is in the cache
+  def addedNotThreadSafe(self, entry) :
+    pass
+
+  # Called by put to throw out entries that have expired by now. An LRU
+  # cache leaves them for get to find, or for the LRU order to push out
+  def expireNotThreadSafe(self, now) :
+    pass
+
+  # Throws out every expired entry. Walks the whole cache, so be careful
+  # about using it
+  def clean(self) :
+    now = time.time()
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      for entry in self.cache.values() :
+        hardtime = entry.expiretime if entry.staleuntil is None else entry.staleuntil
+        if (hardtime is not None and hardtime <= now) :
+          self.removeNotThreadSafe(entry)
+          self.expirations += 1
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+  # "in": has to be there and not expired. Not locked, nor does it have to
+  # be: the point of "in" is to be cheap. Does not count as a hit or miss
+  def __contains__(self, key) :
+    entry = self.cache.get(key)
+    if (entry is None) :
+      return False
+    return entry.expiretime is None or entry.expiretime > time.time()
+
+  def __len__(self) :
+    return len(self.cache)
+
+  # A consistent copy of the counters, plus how full the cache is
+  def stats(self) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      return { 'size'        : len(self.cache),
+               'maxsize'     : self.maxsize,
+               'bytes'       : self.bytes,
+               'maxbytes'    : self.maxbytes,
+               'hits'        : self.hits,
+               'misses'      : self.misses,
+               'evictions'   : self.evictions,
+               'expirations' : self.expirations,
+               'staleHits'   : self.staleHits,
+               'refreshes'   : self.refreshes,
+               'failedRefreshes' : self.failedRefreshes }
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+  def dump(self, count = None) :
+    if (not count) :
+      count = len(self.cache)
     root = self.root
-    MUSTPRINT("LRU CACHE %d DUMP: Cache has %d items in it:"%(self.cacheid,count))
-    ptr = root[1]
+    now = time.time()
+    MUSTPRINT("LRU CACHE %d DUMP: Cache has %d items in it:"%(self.cacheid,len(self.cache)))
+    entry = root.older
     i = 0
-    while ptr is not root :
-      MUSTPRINT("\tItem %d=%s"%(i,ptr[2]))
-      ptr = ptr[1]
+    while entry is not root and i < count :
+      MUSTPRINT("\tItem %d=%s expires in %s seconds"%(i, entry.key,
+                "NEVER" if entry.expiretime is None else "%d"%(entry.expiretime-now)))
+      entry = entry.older
       i += 1
     MUSTPRINT("END OF DUMP")
 
-  def clean(self) :
-    pass
-
-  def removeNotThreadSafe(self, link) :
-    if not link:
-      return
+  def removeNotThreadSafe(self, entry) :
     # Can't unlink root!
-    if link is self.root:
+    if entry is self.root:
       return
-
-    # Link structure: [NEWER, OLDER, KEY, VALUE]
-    newer = 0
-    older = 1
-
-    prev = link[newer]
-    next = link[older]
     # Since it's a circular list, there is no need to check null-ness
-    prev[older] = next
-    next[newer] = prev
-    del self.cache[link[2]]
+    entry.newer.older = entry.older
+    entry.older.newer = entry.newer
+    del self.cache[entry.key]
+    self.bytes -= entry.size
 
-  def moveToNewestNotThreadSafe(self, link) :
-    if not link:
-      return
-    if link is self.root:
-      return
-    newer = 0
-    older = 1
-    usedtobenewest = self.root[older]
-    self.root[older] = usedtobenewest[newer] = link
-    link[older] = usedtobenewest
-    link[newer] = self.root
+  # Also links in a new entry, as a new entry points at itself
+  def moveToNewestNotThreadSafe(self, entry) :
+    root = self.root
+    # Unlink
+    entry.newer.older = entry.older
+    entry.older.newer = entry.newer
+    # And relink between root and the old newest
+    usedtobenewest = root.older
+    entry.newer = root
+    entry.older = usedtobenewest
+    usedtobenewest.newer = entry
+    root.older = entry
 
 
 
 # Expiring caches are like normal caches, only they have a time to live value.
 # If the cache entry is too old, it is removed and NULL is returned
-# The expiration is less a matter of size than it is of age, and so items
-# are only removed when they are accessed after expiration
-# Note that synchronization is necessary
-class ExpiringCache(SimpleCache) :
+# The expiration is less a matter of size than it is of age, so rather than
+# in LRU order, entries are also kept in a min-heap of (expiretime, sequence,
+# entry). Every put pops whatever has expired off the top of the heap, at
+# O(log n) per entry, so dead entries never pile up even if their keys are
+# never asked for again.
+# There is no limit on the number of entries unless maxsize (or maxbytes)
+# is given, in which case the entries closest to expiring are thrown out
+# first to make room.
+# With staleSeconds (see LRUCache), an entry only leaves the heap (and the
+# cache) once its stale window is over too.
+#
+# Entries that are replaced, or removed by get, are left in the heap and
+# skipped once they get to the top. Should they ever make up more than half
+# of it, the heap is rebuilt from the live entries
+class ExpiringCache(LRUCache) :
 
-  def __init__(self, defaultExpirationSeconds):
+  # Heap key of an entry that never expires
+  never = float("inf")
+
+  def __init__(self, defaultExpirationSeconds, **kwargs):
     self.Parent = super(ExpiringCache, self)
-    self.Parent.__init__()
-    self.lock = Semaphore()
+    kwargs.setdefault("maxsize", None)
+    kwargs["defaultTTL"] = defaultExpirationSeconds
+    self.Parent.__init__(**kwargs)
     self.defaultExp = defaultExpirationSeconds
 
-  def get(self, key) :
-    now = time.time()
+  # Throws out every expired entry. Only looks at the expired ones
+  def clean(self) :
     try:
       # START CRITICAL SECTION
       self.lock.acquire()
-      value = self.Parent.get(key)
-      if (not value):
-        return None
-      if (value['expiretime'] is not None and now >= value['expiretime']) :
-        del self.Parent.cache[key]
-        return None
-      return value['value']
+      self.expireNotThreadSafe(time.time())
     finally:
       self.lock.release()
-      # END CRITICAL SECTION
+    # END CRITICAL SECTION
 
+  def stats(self) :
+    retval = LRUCache.stats(self)
+    retval['scheduled'] = len(self.heap)
+    return retval
 
-  def put(self, key, value, **kw) :
-    if ('ttlseconds' in kw) :
-      expirationSecs = kw[ttlseconds]
+  def resetNotThreadSafe(self) :
+    LRUCache.resetNotThreadSafe(self)
+    self.heap = list()
+    self.sequence = itertools.count()
+
+  # Entries leave once they are past any stale window as well
+  def addedNotThreadSafe(self, entry) :
+    if (entry.staleuntil is not None) :
+      expiretime = entry.staleuntil
+    elif (entry.expiretime is not None) :
+      expiretime = entry.expiretime
     else :
-     expirationSecs = self.defaultExp
-    if (expirationSecs is Default) :
-      expirationSecs = self.defaultExp
-    # This is a trick you can use to not put something in the cache
-    if (expirationSecs is not None and expirationSecs <= 0) :
-      return
-    newentry = dict()
-    newentry['value'] = value
-    esecs = self.defaultExp if expirationSecs is None else expirationSecs 
-    newentry['expiretime'] = esecs + time.time()
-    try :
+      expiretime = ExpiringCache.never
+    heapq.heappush(self.heap, (expiretime, next(self.sequence), entry))
+    if (len(self.heap) > 2 * len(self.cache) + 64) :
+      cache = self.cache
+      self.heap = [item for item in self.heap if cache.get(item[2].key) is item[2]]
+      heapq.heapify(self.heap)
+
+  # Pops dead entries off the heap until a live one is on top, and
+  # returns the top (expiretime, sequence, entry), or None if empty
+  def liveTopNotThreadSafe(self) :
+    heap = self.heap
+    cache = self.cache
+    while heap :
+      top = heap[0]
+      if (cache.get(top[2].key) is top[2]) :
+        return top
+      heapq.heappop(heap)
+    return None
+
+  # Closest to expiring goes first
+  def victimNotThreadSafe(self) :
+    return self.liveTopNotThreadSafe()[2]
+
+  def expireNotThreadSafe(self, now) :
+    while True :
+      top = self.liveTopNotThreadSafe()
+      if (top is None or top[0] > now) :
+        return
+      heapq.heappop(self.heap)
+      self.removeNotThreadSafe(top[2])
+      self.expirations += 1
+
+
+
+#
+# Lock striped cache, for when many request threads hit the same cache
+# (app.yaml says threadsafe). Keys are hashed to one of segmentCount
+# independent caches (segmentClass, LRUCache by default), each with its own
+# lock and its own LRU/TTL bookkeeping, so threads only wait on each other
+# when their keys land in the same segment.
+#
+# The rest of the keyword arguments go to each segment, except that
+# maxsize and maxbytes are the limits for the cache as a whole, and are
+# split evenly across the segments. The LRU order (or expiry order) is
+# per segment, so what gets evicted is only approximately the globally
+# oldest
+#
+class ShardedCache(object) :
+
+  def __init__(self, segmentCount=16, segmentClass=LRUCache, **kwargs) :
+    self.cacheid = randint(0,1000000000)
+    for limit in ("maxsize", "maxbytes") :
+      if (kwargs.get(limit) is not None) :
+        kwargs[limit] = (kwargs[limit] + segmentCount - 1) // segmentCount
+    self.segments = [segmentClass(**kwargs) for i in range(segmentCount)]
+
+  def segment(self, key) :
+    return self.segments[hash(key) % len(self.segments)]
+
+  def get(self, key, refresh=None) :
+    return self.segments[hash(key) % len(self.segments)].get(key, refresh)
+
+  def put(self, key, value, **kw) :
+    self.segments[hash(key) % len(self.segments)].put(key, value, **kw)
+
+  def peek(self, key) :
+    return self.segments[hash(key) % len(self.segments)].peek(key)
+
+  def clear(self) :
+    for segment in self.segments :
+      segment.clear()
+
+  def clean(self) :
+    for segment in self.segments :
+      segment.clean()
+
+  def __contains__(self, key) :
+    return key in self.segment(key)
+
+  def __len__(self) :
+    return sum(len(segment) for segment in self.segments)
+
+  # The segments' counters and sizes added up. Each segment's are
+  # consistent, but the segments are not all read at the same instant
+  def stats(self) :
+    retval = dict()
+    for segment in self.segments :
+      for name, value in segment.stats().items() :
+        if (value is None or retval.get(name, 0) is None) :
+          retval[name] = None
+        else :
+          retval[name] = retval.get(name, 0) + value
+    retval['segments'] = len(self.segments)
+    return retval
+
+  def dump(self, count = None) :
+    for i, segment in enumerate(self.segments) :
+      MUSTPRINT("SHARDED CACHE %d SEGMENT %d:"%(self.cacheid, i))
+      segment.dump(count)
+
+
+
+# A SingleFlight waiter gave up on the call it was waiting for
+class FlightTimeout(Exception) :
+  pass
+
+#
+# One fetch in progress for SingleFlight: the callers waiting on it are
+# woken by done once result (or error) is filled in
+#
+class Flight(object) :
+  __slots__ = ('done', 'result', 'error')
+
+  def __init__(self) :
+    self.done = Event()
+    self.result = None
+    self.error = None
+
+
+#
+# Single flight request coalescing. Put in front of an expensive upstream
+# call (a SODA query, a paid geocode) so that when several threads miss the
+# cache for the same key at once, only the first one makes the call. The
+# others wait for it and get the same result, or the same exception
+# (any exception: a DeadlineExceededError ends their wait too).
+# They wait at most maxWait seconds, by default a bit less than App
+# Engine's 60 second request deadline, so that a waiter fails with
+# FlightTimeout of its own before its request is killed.
+#
+# calls => how many times the function was actually called
+# coalesced => how many callers got a result without calling it
+# timeouts => how many callers gave up waiting
+#
+class SingleFlight(object) :
+
+  def __init__(self, maxWait=55) :
+    self.lock = Lock()
+    self.flights = dict()
+    self.maxWait = maxWait
+    self.calls = 0
+    self.coalesced = 0
+    self.timeouts = 0
+
+  # Returns function(*args, **kwargs), unless a call for key is already
+  # in progress, in which case its outcome is returned (or raised)
+  def do(self, key, function, *args, **kwargs) :
+    try:
       # START CRITICAL SECTION
       self.lock.acquire()
-      self.Parent.put(key, newentry)
+      flight = self.flights.get(key)
+      leader = flight is None
+      if (leader) :
+        flight = self.flights[key] = Flight()
+        self.calls += 1
+      else :
+        self.coalesced += 1
     finally:
       self.lock.release()
+    # END CRITICAL SECTION
+
+    if (not leader) :
+      if (not flight.done.wait(self.maxWait)) :
+        try:
+          # START CRITICAL SECTION
+          self.lock.acquire()
+          self.timeouts += 1
+        finally:
+          self.lock.release()
+        # END CRITICAL SECTION
+        raise FlightTimeout("Gave up on \"%s\" after %s seconds"%(str(key), str(self.maxWait)))
+      if (flight.error is not None) :
+        raise flight.error
+      return flight.result
+
+    try:
+      flight.result = function(*args, **kwargs)
+      return flight.result
+    except BaseException as e:
+      flight.error = e
+      raise
+    finally:
+      # Callers from here on make a call of their own (or, more likely,
+      # find the result in the cache)
+      try:
+        # START CRITICAL SECTION
+        self.lock.acquire()
+        del self.flights[key]
+      finally:
+        self.lock.release()
       # END CRITICAL SECTION
+      flight.done.set()
 
-  # Clean is pretty expensive, be casreful about using it
-  def clean(self) :
-    now = time.time()
+  def stats(self) :
     try:
       # START CRITICAL SECTION
       self.lock.acquire()
-      for k in self.cache.keys() :
-        v = self.cache.get(k)
-        if v is not None:
-          etime = v.get('expiretime')
-          if etime is not None and etime <= now:
-            del self.cache[k]
+      return { 'calls'     : self.calls,
+               'coalesced' : self.coalesced,
+               'timeouts'  : self.timeouts,
+               'inflight'  : len(self.flights) }
     finally:
       self.lock.release()
-      # END CRITICAL SECTION
+    # END CRITICAL SECTION
 
-  # "in" in an expiring cache: have to see if it's in there and if the expiration time
-  # is over. Note that this is not particularly threadsafe, nor does it have to be...
-  # the point of "in" is to be cheap
-  def __contains__(self, key) :
-    value = self.cache.get(key)
-    t = time.time()
-    e = value['expiretime']
-    #print("key=%s, value = %f, now = %f"%(str(key),e,t))
 
-    # Expiration caches NEVER have None entries
-    if value is None:
-      return False
 
-    # Check expiration
-    if e <= t :
-      return False
+#
+# Token bucket rate limiter with a daily budget, to put in front of a paid
+# API (the geocoder). Threadsafe: one is shared by every request thread.
+#
+# acquire takes one token. Tokens come back at qps per second, up to burst
+# of them saved up. When there are none, the caller waits its turn (tokens
+# may go negative: each caller waits for its own), but never more than
+# maxWait seconds. Rather than wait longer, or once dailyBudget calls have
+# been made today (UTC), the call is shed: acquire returns False, and the
+# caller is expected to do without.
+#
+# When the API says the quota is exceeded anyway, quotaError holds every
+# caller off for a while, and backoff says how long to wait before trying
+# again: exponential in the attempt, with jitter so that the threads that
+# were all turned away at once do not all come back at once.
+#
+# Counts are kept per day, for the last keepDays days
+#
+# Everything is counted per instance, so with several instances up, the
+# rate is qps times the number of instances, and so is the daily budget,
+# unless sharedBudgetKey is given: then (on the App Engine) the day's calls
+# are also counted in memcache under that key, and dailyBudget holds for
+# every instance put together. Memcache may lose the count (it is a cache),
+# in which case the day starts over from 0 there; the instance's own count
+# still holds it to dailyBudget
+#
+class RateLimiter(object) :
+
+  keepDays = 7
 
-    # If we got this far, we're good to go:
+  def __init__(self, qps, burst=Default, dailyBudget=None, maxWait=None, backoffBase=0.5, backoffCap=8.0,
+               sharedBudgetKey=None) :
+    if burst is Default:
+      burst = max(1.0, qps)
+    self.qps = float(qps)
+    self.burst = float(burst)
+    self.dailyBudget = dailyBudget
+    self.maxWait = maxWait
+    self.backoffBase = backoffBase
+    self.backoffCap = backoffCap
+    self.sharedBudgetKey = sharedBudgetKey if memcache is not None else None
+    self.lock = Lock()
+    self.random = Random()
+    self.tokens = self.burst
+    self.lastRefill = time.time()
+    self.blockedUntil = 0
+    self.days = dict()
+
+  @staticmethod
+  def today() :
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+  # Returns the counts for today, starting a new day (and forgetting the
+  # oldest one) if need be
+  def dayNotThreadSafe(self) :
+    today = RateLimiter.today()
+    counts = self.days.get(today)
+    if (counts is None) :
+      counts = self.days[today] = { 'calls' : 0, 'shed' : 0, 'quotaErrors' : 0, 'retries' : 0 }
+      for day in sorted(self.days)[:-RateLimiter.keepDays] :
+        del self.days[day]
+    return counts
+
+  # Returns True once the call may be made, or False if it is shed
+  def acquire(self) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      now = time.time()
+      counts = self.dayNotThreadSafe()
+      if (self.dailyBudget is not None and counts['calls'] >= self.dailyBudget) :
+        counts['shed'] += 1
+        return False
+      self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.qps)
+      self.lastRefill = now
+      wait = max(self.blockedUntil - now, (1 - self.tokens) / self.qps, 0)
+      if (self.maxWait is not None and wait > self.maxWait) :
+        counts['shed'] += 1
+        return False
+      self.tokens -= 1
+      counts['calls'] += 1
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+    if (self.dailyBudget is not None and self.sharedBudgetKey is not None) :
+      shared = self.sharedCalls(1)
+      if (shared is not None and shared > self.dailyBudget) :
+        try:
+          # START CRITICAL SECTION
+          self.lock.acquire()
+          counts['calls'] -= 1
+          counts['shed'] += 1
+          self.tokens += 1
+        finally:
+          self.lock.release()
+        # END CRITICAL SECTION
+        return False
+    if (wait > 0) :
+      time.sleep(wait)
     return True
 
-  def dump(self, count = None) :
-    if (not count) :
-      count = len(self.cache)
-      
-    print("%d value, displaying the first %d keys"%(len(self.cache), count))
-    i = 0
-    keys = sorted(self.cache.keys())
+  # Adds delta to today's calls by every instance (see sharedBudgetKey),
+  # and returns the new count, or None if memcache could not say
+  def sharedCalls(self, delta=0) :
+    key = "ratelimiter:%s:%s"%(self.sharedBudgetKey, RateLimiter.today())
+    try:
+      if (delta) :
+        return memcache.incr(key, delta, initial_value=0)
+      return memcache.get(key)
+    except Exception as e:
+      INFOPRINT("Shared budget count for %s failed: %s"%(self.sharedBudgetKey, str(e)), 5)
+      return None
+
+  # How long to wait before retry number attempt (0 for the first retry)
+  def backoff(self, attempt) :
+    delay = min(self.backoffCap, self.backoffBase * (2 ** attempt))
+    return delay / 2 + self.random.uniform(0, delay / 2)
+
+  # The API turned a call down for going over quota. Holds everyone off
+  # for delay seconds
+  def quotaError(self, delay) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      self.dayNotThreadSafe()['quotaErrors'] += 1
+      self.blockedUntil = max(self.blockedUntil, time.time() + delay)
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+  def retried(self) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      self.dayNotThreadSafe()['retries'] += 1
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+  def stats(self) :
+    shared = self.sharedCalls() if self.sharedBudgetKey is not None else None
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      self.dayNotThreadSafe()
+      return { 'qps'         : self.qps,
+               'dailyBudget' : self.dailyBudget,
+               'sharedCallsToday' : shared,
+               'days'        : dict((day, dict(counts)) for day, counts in self.days.iteritems()) }
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+
+
+#
+# Persistent second tier for a cache, so that what was paid for survives an
+# instance restart. An append-only log: every put is one JSON line of
+# [key, value, expiretime], and the last line for a key wins. The whole log
+# is read back at startup (load), and preload then hands whatever has not
+# expired yet to an in-memory cache in one go.
+#
+# Replaced and expired entries are left in the log until it holds more than
+# twice as many lines as live entries, at which point it is rewritten
+# (to a temporary file, renamed over the log, so a crash leaves either the
+# old or the new one).
+#
+# Keys must be strings, and values anything JSON can hold. If the file
+# cannot be written (the App Engine filesystem is read only), that is logged
+# once and the store goes on without it: whatever could be read is still
+# preloaded. On the App Engine, use DatastoreStore instead
+#
+class LogStore(object) :
+
+  def __init__(self, path) :
+    self.path = path
+    self.lock = Lock()
+    self.entries = dict()
+    self.lines = 0
+    self.file = None
+    self.writable = True
+    self.appends = 0
+    self.compactions = 0
+
+  # Reads the log in. A torn last line (from a crash mid-write) is skipped.
+  # Returns the number of live entries
+  def load(self) :
     now = time.time()
-    for key in keys:
-      if i >= count :
-        break
-      i += 1
-      print("Element %d=\"%s\" expires in %d seconds"%(i,
-                                                       self.cache[key]['value'], 
-                   "NEVER" if self.cache[key]['expiretime'] is None else (self.cache[key]['expiretime']-now)))
+    entries = dict()
+    lines = 0
+    try:
+      with open(self.path, "r") as infile :
+        for line in infile :
+          try:
+            key, value, expiretime = json.loads(line)
+          except ValueError:
+            continue
+          lines += 1
+          entries[str(key)] = (value, expiretime)
+    except IOError as e:
+      INFOPRINT("No cache log %s: %s"%(self.path, str(e)), 1)
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      self.entries = dict((key, entry) for key, entry in entries.iteritems()
+                          if (entry[1] is None or entry[1] > now))
+      self.lines = lines
+      return len(self.entries)
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+  # Returns (value, expiretime) for key, or None if it is not there or
+  # has expired
+  def get(self, key) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      entry = self.entries.get(key)
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+    if (entry is None or (entry[1] is not None and entry[1] <= time.time())) :
+      return None
+    return entry
+
+  # expiretime is absolute (time.time()), or None for never
+  def put(self, key, value, expiretime=None) :
+    line = json.dumps([key, value, expiretime], separators=(',',':')) + "\n"
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      self.entries[key] = (value, expiretime)
+      if (not self.writable) :
+        return
+      try:
+        if (self.file is None) :
+          self.file = open(self.path, "a")
+        self.file.write(line)
+        self.file.flush()
+        self.lines += 1
+        self.appends += 1
+        if (self.lines > 2 * len(self.entries) + 1000) :
+          self.compactNotThreadSafe()
+      except (IOError, OSError) as e:
+        MUSTPRINT("Cache log %s is not writable, keeping it in memory only: %s"%(self.path, str(e)))
+        self.writable = False
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+  # Returns a list of (key, value, expiretime) that have not expired yet
+  def items(self) :
+    now = time.time()
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      return [(key, entry[0], entry[1]) for key, entry in self.entries.iteritems()
+              if (entry[1] is None or entry[1] > now)]
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+  # Puts every live entry into cache, with whatever time it has left.
+  # Returns how many were put
+  def preload(self, cache) :
+    now = time.time()
+    retval = 0
+    for key, value, expiretime in self.items() :
+      if (expiretime is None) :
+        cache.put(key, value)
+      else :
+        cache.put(key, value, ttlSeconds=expiretime - now)
+      retval += 1
+    return retval
+
+  # Rewrites the log with only the live entries
+  def compact(self) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      if (self.writable) :
+        self.compactNotThreadSafe()
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+  def compactNotThreadSafe(self) :
+    now = time.time()
+    self.entries = dict((key, entry) for key, entry in self.entries.iteritems()
+                        if (entry[1] is None or entry[1] > now))
+    temppath = self.path + ".tmp"
+    with open(temppath, "w") as outfile :
+      for key, entry in self.entries.iteritems() :
+        outfile.write(json.dumps([key, entry[0], entry[1]], separators=(',',':')) + "\n")
+    if (self.file is not None) :
+      self.file.close()
+      self.file = None
+    os.rename(temppath, self.path)
+    self.lines = len(self.entries)
+    self.compactions += 1
+
+  def stats(self) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      return { 'entries'     : len(self.entries),
+               'lines'       : self.lines,
+               'appends'     : self.appends,
+               'compactions' : self.compactions,
+               'writable'    : self.writable }
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
 
 
+#
+# The same as a LogStore, but in the App Engine Datastore, which, unlike the
+# App Engine filesystem, can be written to, and is shared by every instance.
+# ndb puts memcache in front of it, so a get is usually a memcache call.
+# There could be any number of entries, so nothing is preloaded: they are
+# looked up one at a time (get) when the cache in front misses.
+#
+# Entries are StoredValue entities keyed "<name>:<key>" (the key is hashed
+# if it is too long for a key name). Expired ones are left where they are,
+# until the next put of the same key replaces them.
+# Datastore failures are logged and counted, and the store is done without
+#
+if (ndb is not None) :
+  class StoredValue(ndb.Model) :
+    value = ndb.JsonProperty(indexed=False)
+    expiretime = ndb.FloatProperty(indexed=False)
+
+class DatastoreStore(object) :
+
+  # Longest key used as is in a key name (the limit is 1500 bytes)
+  maxKeyLength = 400
+
+  def __init__(self, name) :
+    self.name = name
+    self.lock = Lock()
+    self.gets = 0
+    self.found = 0
+    self.puts = 0
+    self.errors = 0
+
+  # Whether there is a Datastore to be had (there is not outside the App Engine)
+  @staticmethod
+  def available() :
+    return ndb is not None
+
+  def entityKey(self, key) :
+    if (isinstance(key, unicode)) :
+      key = key.encode("utf-8")
+    if (len(key) > DatastoreStore.maxKeyLength) :
+      key = hashlib.md5(key).hexdigest()
+    return ndb.Key(StoredValue, self.name + ":" + key)
+
+  def count(self, counter) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      setattr(self, counter, getattr(self, counter) + 1)
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+  # Nothing to read in ahead of time
+  def load(self) :
+    return 0
+
+  def preload(self, cache) :
+    return 0
+
+  # Returns (value, expiretime) for key, or None if it is not there or
+  # has expired
+  def get(self, key) :
+    self.count('gets')
+    try:
+      entity = self.entityKey(key).get()
+    except Exception as e:
+      self.count('errors')
+      INFOPRINT("Datastore get of \"%s\" failed: %s"%(str(key), str(e)), 5)
+      return None
+    if (entity is None or (entity.expiretime is not None and entity.expiretime <= time.time())) :
+      return None
+    self.count('found')
+    return entity.value, entity.expiretime
+
+  # expiretime is absolute (time.time()), or None for never
+  def put(self, key, value, expiretime=None) :
+    self.count('puts')
+    try:
+      StoredValue(key=self.entityKey(key), value=value, expiretime=expiretime).put()
+    except Exception as e:
+      self.count('errors')
+      INFOPRINT("Datastore put of \"%s\" failed: %s"%(str(key), str(e)), 5)
+
+  def stats(self) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      return { 'gets'   : self.gets,
+               'found'  : self.found,
+               'puts'   : self.puts,
+               'errors' : self.errors }
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+
+
+# Microbenchmark: times put, then get (on a shuffled mix of keys that are
+# and are not in the cache), single threaded. keys should be about twice
+# the cache's maxsize so that puts evict and half the gets miss.
+# Returns (put usec, get usec) per operation
+def benchmarkCache(cache, keycount=2000, rounds=20) :
+  keys = ["/?cmd=ts&input=Movie+%d"%i for i in range(keycount)]
+  lookups = list(keys)
+  Random(1).shuffle(lookups)
+  start = time.time()
+  for r in range(rounds) :
+    for key in keys :
+      cache.put(key, key)
+  putTime = time.time() - start
+  start = time.time()
+  for r in range(rounds) :
+    for key in lookups :
+      cache.get(key)
+  getTime = time.time() - start
+  ops = float(rounds * keycount)
+  return putTime * 1000000 / ops, getTime * 1000000 / ops
+
+
+# Multithreaded benchmark: threadcount threads each do opsPerThread
+# operations on cache, 9 gets to every put, on random keys out of keycount.
+# Returns the total operations per second
+def benchmarkThreads(cache, threadcount, opsPerThread=20000, keycount=2000) :
+  keys = ["/?cmd=ts&input=Movie+%d"%i for i in range(keycount)]
+  for key in keys[:keycount // 2] :
+    cache.put(key, key)
+  def worker(seed) :
+    rand = Random(seed)
+    get = cache.get
+    put = cache.put
+    for i in range(opsPerThread) :
+      key = keys[rand.randrange(keycount)]
+      if (i % 10) :
+        get(key)
+      else :
+        put(key, key)
+  threads = [Thread(target=worker, args=(seed,)) for seed in range(threadcount)]
+  start = time.time()
+  for thread in threads :
+    thread.start()
+  for thread in threads :
+    thread.join()
+  return threadcount * opsPerThread / (time.time() - start)
+
 
 # Urlencoding happens so often that we can speed things up by caching them.
 # As always, the dataset is small enough that we need not make this an LRU cache
@@ -351,9 +1200,19 @@ import fileinput
 
 # Main: unit test
 if __name__ == '__main__':
-  print("cache type? [e/l] >", end="")
+  print("cache type? [e/l/b(enchmark)] >", end="")
   line = sys.stdin.readline()
-  if ('e' in line) :
+  if ('b' in line) :
+    for cache in (LRUCache(maxsize=1000), ExpiringCache(864000)) :
+      putTime, getTime = benchmarkCache(cache)
+      print("%s: put %.2f usec, get %.2f usec"%(cache.__class__.__name__, putTime, getTime))
+      print(json.dumps(cache.stats()))
+    for threadcount in (1, 2, 4, 8) :
+      for cache in (LRUCache(maxsize=1000), ShardedCache(16, maxsize=1000)) :
+        print("%s, %d threads: %d ops/sec"%(cache.__class__.__name__, threadcount,
+                                             benchmarkThreads(cache, threadcount)))
+    sys.exit(0)
+  elif ('e' in line) :
     print("Using expiring cache")
     cache = ExpiringCache(10)
   else:
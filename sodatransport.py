@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+#
+# Code Challenge for Mark Gerolimatos
+# (SF Movie Database)
+# mark@gerolimatos.com
+# 650 703-4774
+# (c) Mark Gerolimatos, save for code borrowed and credited
+#
+# October, 2014
+#
+from __future__ import print_function
+
+from BaseImport import *
+from threading import Lock
+import threading, json
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import connection as urllib3connection
+from requests.packages.urllib3 import connectionpool
+
+#
+# The HTTP side of talking to SODA, shared by every SoQLInterface.
+#
+# requests.get opens (and then throws away) a new connection every time.
+# A Session keeps them open instead, pooled per host: at most
+# hostConnections to any one host (more callers wait for one to be free),
+# and pools for at most poolSize hosts. Bodies are asked for gzipped.
+#
+# Every request is timed, in four parts:
+# connect => opening a new connection, if one had to be (0 if not)
+# firstByte => from sending the request to having the response headers
+# download => reading (and unzipping) the body
+# decode => JSON decoding it
+#
+# A copy of a response already held can be revalidated instead of fetched
+# again (see conditionalGet): the request carries the copy's validators
+# (its ETag and Last-Modified), and if it has not changed, the answer is a
+# 304 with no body to download or decode.
+#
+
+# Seconds spent opening connections on this thread, since the last request
+# was started. Filled in by the Timed connections below
+connectTimes = threading.local()
+
+class TimedHTTPConnection(urllib3connection.HTTPConnection) :
+  def connect(self) :
+    start = time.time()
+    try:
+      urllib3connection.HTTPConnection.connect(self)
+    finally:
+      connectTimes.seconds = getattr(connectTimes, "seconds", 0) + time.time() - start
+
+class TimedHTTPSConnection(urllib3connection.HTTPSConnection) :
+  def connect(self) :
+    start = time.time()
+    try:
+      urllib3connection.HTTPSConnection.connect(self)
+    finally:
+      connectTimes.seconds = getattr(connectTimes, "seconds", 0) + time.time() - start
+
+class TimedHTTPConnectionPool(connectionpool.HTTPConnectionPool) :
+  ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool) :
+  ConnectionCls = TimedHTTPSConnection
+
+# HTTPAdapter whose pools make Timed connections
+class TimedAdapter(HTTPAdapter) :
+  def init_poolmanager(self, *args, **kwargs) :
+    HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = { 'http'  : TimedHTTPConnectionPool,
+                                                'https' : TimedHTTPSConnectionPool }
+
+
+class SodaTransport(object) :
+
+  # Timed parts of a request, in order
+  phases = ('connect', 'firstByte', 'download', 'decode')
+
+  def __init__(self, poolSize=4, hostConnections=8, timeout=(6.05, 22)) :
+    self.session = requests.Session()
+    adapter = TimedAdapter(pool_connections=poolSize, pool_maxsize=hostConnections, pool_block=True)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+    self.session.headers['Accept-Encoding'] = "gzip, deflate"
+    # The mysterious 6.05 seconds on connect timeout is to prevent
+    # TCP from opening the connetion just as we give up
+    self.timeout = timeout
+    # One decoder for every pooled thread. That is safe: a JSONDecoder is
+    # set up once, in its constructor, and decode keeps all of its state
+    # in local variables, so two threads decoding at once cannot step on
+    # each other
+    self.decoder = json.JSONDecoder()
+    self.lock = Lock()
+    self.requests = 0
+    self.connects = 0
+    # Responses that came with a validator, requests that sent one, and
+    # of those, the ones answered "304 Not Modified"
+    self.validated = 0
+    self.conditional = 0
+    self.notModified = 0
+    self.wireBytes = 0
+    self.bodyBytes = 0
+    self.totals = dict((phase, 0.0) for phase in SodaTransport.phases)
+    self.maxima = dict((phase, 0.0) for phase in SodaTransport.phases)
+
+  # GETs url, and returns (status code, decoded JSON body).
+  # Raises whatever requests does (e.g. requests.exceptions.Timeout), or
+  # ValueError if the body is not JSON
+  def get(self, url) :
+    statusCode, retval, validators = self.conditionalGet(url)
+    return statusCode, retval
+
+  # Same as get, but returns (status code, decoded JSON body, validators).
+  # validators is a dict with the 'etag' and 'lastModified' headers of
+  # the response, where it had them, or None if it had neither.
+  # If validators is given (those of a copy already held), the request is
+  # conditional: when the copy is still good, the status is 304, the body
+  # None, and the validators handed back are the given ones, brought up
+  # to date with any the 304 came with
+  def conditionalGet(self, url, validators=None) :
+    headers = dict()
+    if (validators) :
+      if (validators.get('etag')) :
+        headers['If-None-Match'] = validators['etag']
+      if (validators.get('lastModified')) :
+        headers['If-Modified-Since'] = validators['lastModified']
+    connectTimes.seconds = 0
+    start = time.time()
+    response = self.session.get(url, headers=headers, timeout=self.timeout, stream=True)
+    headersAt = time.time()
+    notModified = bool(headers) and response.status_code == 304
+    # Read even when there is nothing to read (a 304): that is what hands
+    # the connection back to the pool
+    content = response.content
+    downloadedAt = time.time()
+    retval = None if notModified else self.decoder.decode(content)
+    decodedAt = time.time()
+
+    received = dict()
+    if (response.headers.get('ETag')) :
+      received['etag'] = response.headers['ETag']
+    if (response.headers.get('Last-Modified')) :
+      received['lastModified'] = response.headers['Last-Modified']
+    if (notModified) :
+      validators = dict(validators, **received)
+    else :
+      validators = received or None
+
+    connect = connectTimes.seconds
+    timings = { 'connect'   : connect,
+                'firstByte' : headersAt - start - connect,
+                'download'  : downloadedAt - headersAt,
+                'decode'    : decodedAt - downloadedAt }
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      self.requests += 1
+      if (connect > 0) :
+        self.connects += 1
+      if (received) :
+        self.validated += 1
+      if (headers) :
+        self.conditional += 1
+      if (notModified) :
+        self.notModified += 1
+      self.wireBytes += response.raw.tell()
+      self.bodyBytes += len(content)
+      for phase, seconds in timings.iteritems() :
+        self.totals[phase] += seconds
+        self.maxima[phase] = max(self.maxima[phase], seconds)
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+    if (ISLEVEL(2)) : INFOPRINT("%s: %s"%(url, ", ".join("%s %.1fms"%(phase, timings[phase] * 1000)
+                                                          for phase in SodaTransport.phases)), 2)
+    return response.status_code, retval, validators
+
+  # Counts, and average and maximum milliseconds for each part of a request
+  def stats(self) :
+    try:
+      # START CRITICAL SECTION
+      self.lock.acquire()
+      count = max(1, self.requests)
+      return { 'requests'  : self.requests,
+               'connects'  : self.connects,
+               'validated' : self.validated,
+               'conditional' : self.conditional,
+               'notModified' : self.notModified,
+               'wireBytes' : self.wireBytes,
+               'bodyBytes' : self.bodyBytes,
+               'averageMs' : dict((phase, self.totals[phase] * 1000 / count) for phase in SodaTransport.phases),
+               'maxMs'     : dict((phase, self.maxima[phase] * 1000) for phase in SodaTransport.phases) }
+    finally:
+      self.lock.release()
+    # END CRITICAL SECTION
+
+
+
+# Times count GETs of url with a new connection for every one (requests.get,
+# as SoQLInterface used to), and through a SodaTransport.
+# Returns (requests.get msec, transport msec) per request, and the
+# transport's stats
+def benchmarkTransport(url, count=500) :
+  start = time.time()
+  for i in range(count) :
+    response = requests.get(url, timeout=(6.05, 22))
+    json.loads(response.content)
+  plainTime = time.time() - start
+  transport = SodaTransport()
+  start = time.time()
+  for i in range(count) :
+    transport.get(url)
+  transportTime = time.time() - start
+  return plainTime * 1000 / count, transportTime * 1000 / count, transport.stats()
+
+
+# Times count GETs of url through a SodaTransport, downloading the body
+# every time, and then revalidating a copy of it instead.
+# Returns (download msec, revalidate msec) per request, and the stats
+def benchmarkRevalidation(url, count=500) :
+  transport = SodaTransport()
+  start = time.time()
+  for i in range(count) :
+    statusCode, retval, validators = transport.conditionalGet(url)
+  fullTime = time.time() - start
+  start = time.time()
+  for i in range(count) :
+    transport.conditionalGet(url, validators)
+  revalidateTime = time.time() - start
+  return fullTime * 1000 / count, revalidateTime * 1000 / count, transport.stats()
+
+
+# Main: benchmark against a local stand-in, with a body about the size of
+# a title search
+if __name__ == '__main__':
+  from standin import SodaStandIn
+  server = SodaStandIn(json.dumps([{ 'title' : "Vertigo", 'release_year' : "1958",
+                                     'locations' : "%d Franklin Street"%i } for i in range(30)])).start()
+  url = server.url("/resource/yitu-d5am.json")
+  plainMs, transportMs, stats = benchmarkTransport(url)
+  print("requests.get: %.3f msec/request"%plainMs)
+  print("SodaTransport: %.3f msec/request"%transportMs)
+  print(json.dumps(stats, indent=2))
+  fullMs, revalidateMs, stats = benchmarkRevalidation(url)
+  print("Download: %.3f msec/request"%fullMs)
+  print("Revalidate: %.3f msec/request"%revalidateMs)
+  print(json.dumps(stats, indent=2))
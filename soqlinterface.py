@@ -9,9 +9,21 @@
 # October, 2014
 #
 
-import  requests, urllib, json
+import  requests, urllib, json, functools
 from  BaseImport import *
 from simplecache import *
+from sodatransport import SodaTransport
+from array import array
+
+# A query (or one page of it) could not be had
+class SoQLError(Exception) :
+  pass
+
+# Fetches url again for a stale cache entry (see LRUCache.scheduleRefresh).
+# Module level, so that it can go on the task queue
+def refreshUrl(hostname, datasetname, url, cacheExpiration=None) :
+  si = SoQLInterface(hostname, datasetname)
+  SoQLInterface.flights.do(url, si.fetch, url, cacheExpiration)
 
 #
 # This class provides us with an interface to a SODA site's query intervfce
@@ -22,7 +34,25 @@ class SoQLInterface :
   # Class static member that will hold the cache of all our requests.
   # By default, members of an expiring cache go away after 10 days
   # ExpiringCache is threadsafe
-  cache   = ExpiringCache(864000)
+  # There are only about a thousand titles and a couple thousand locations,
+  # so the size limit only kicks in if something is badly wrong.
+  # Expired results are still served for up to a day while they are fetched
+  # again (or just revalidated, see fetch), or for as long as SODA is failing
+  cache   = ExpiringCache(864000, maxsize=10000, staleSeconds=86400)
+  # Requests to SODA in progress, by URL
+  flights = SingleFlight()
+  # Kept-open, pooled, gzipped connections to SODA, shared by all
+  transport = SodaTransport()
+  # What a search returns of each row
+  searchColumns = 'locations, title, release_year'
+  # Local copy of the whole dataset (see DatasetMirror). When it is
+  # loaded, searches are answered from it instead of going to SODA
+  mirror = None
+  # How SODA is reached. The transport keeps connections open and reuses
+  # them for every request, so they had better not be plaintext. May be
+  # set to "http" for a local stand-in (see DatasetStandIn in
+  # standin.py), for testing
+  scheme = "https"
 
   # Takes a URL and return a list of dicts that correspond to
   # each result
@@ -30,10 +60,9 @@ class SoQLInterface :
   # out
   # If there are no results, the empty list results
   def __init__(self, hostname, datasetname) :
-    self.baseurl = "http://" + hostname + "/resource/" + datasetname + ".json"
-    # we create our own decoder lest there be unadvertised race conditions
-    # when two threads request a decode.
-    self.decoder = json.JSONDecoder()
+    self.hostname = hostname
+    self.datasetname = datasetname
+    self.baseurl = SoQLInterface.scheme + "://" + hostname + "/resource/" + datasetname + ".json"
   
 
   #
@@ -46,6 +75,39 @@ class SoQLInterface :
             whereClause=None,
             orderClause=None,
             groupClause=None) :
+    url = self.getUrl(selectClause, whereClause, orderClause, groupClause)
+
+    # Look up in the cache first. A stale entry is good enough for now,
+    # and is queued to be fetched again (see LRUCache.get)
+    refresh = functools.partial(refreshUrl, self.hostname, self.datasetname, url, cacheExpiration)
+    cacheEntry = SoQLInterface.cache.get(url, refresh)
+
+    if (cacheEntry) :
+      # Prevent unnecessary generation of a string
+      if (ISLEVEL(3)) : INFOPRINT("Using cache for URL %s"%url,3)
+      return cacheEntry
+
+    # When a popular entry expires, everyone misses at once. Only the first
+    # one goes to SODA, the rest wait for its answer
+    return SoQLInterface.flights.do(url, self.fetch, url, cacheExpiration)
+
+  # The URL doGet fetches (and caches under) for the clauses
+  def getUrl(self,
+             selectClause=None,
+             whereClause=None,
+             orderClause=None,
+             groupClause=None) :
+    # Frankly, 50000 is good enough: we don't have to worry about paging.
+    # (Except for the whole dataset: see iterRows)
+    url = self.buildUrl(selectClause, whereClause, orderClause, groupClause)
+    return url + ("&" if "?" in url else "?") + "$limit=50000"
+
+  # The query URL for the clauses, without a limit
+  def buildUrl(self,
+               selectClause=None,
+               whereClause=None,
+               orderClause=None,
+               groupClause=None) :
     url = self.baseurl
     queryChar = "?"
     if (selectClause) :
@@ -62,26 +124,88 @@ class SoQLInterface :
     if (orderClause) :
       url += queryChar + "$order=" + UrlEncoder.encode(orderClause)
       queryChar = "&"
-    # Frankly, 50000 is good enough: we don't have to worry about paging.
-    url += queryChar + "$limit=50000"
+    return url
 
-    # Look up in the cache first
-    cacheEntry = SoQLInterface.cache.get(url)
+  # Pages through the results of a query, pageSize rows at a time,
+  # yielding each row. Only one page is ever held (plus the next one,
+  # which is fetched while the rows of the one before are being used), so
+  # a big query need not be held in memory all at once, and the caller
+  # can get to work on the first rows while the rest are on their way.
+  # Nothing is cached.
+  # Paging needs a stable order, so orderClause defaults to ":id" (row id)
+  # Raises SoQLError if a page could not be had
+  def iterRows(self,
+               selectClause=None,
+               whereClause=None,
+               orderClause=":id",
+               pageSize=1000) :
+    url = self.buildUrl(selectClause, whereClause, orderClause)
+    url += ("&" if "?" in url else "?") + "$limit=%d&$offset="%pageSize
+    offset = 0
+    flight = self.prefetchPage(url + str(offset))
+    while (flight is not None) :
+      flight.done.wait()
+      if (flight.error is not None) :
+        raise flight.error
+      page = flight.result
+      offset += pageSize
+      # A short page is the last one
+      flight = self.prefetchPage(url + str(offset)) if (len(page) == pageSize) else None
+      for row in page :
+        yield row
 
-    if (cacheEntry) :
-      # Prevent unnecessary generation of a string
-      if (ISLEVEL(3)) : INFOPRINT("Using cache for URL %s"%url,3)
-      return cacheEntry
+  # Starts fetching one page of iterRows in the background. Returns the
+  # Flight that it will be in
+  def prefetchPage(self, url) :
+    flight = Flight()
+    def fetchPage() :
+      try:
+        flight.result = self.fetchPage(url)
+      except Exception as e:
+        flight.error = e
+      finally:
+        flight.done.set()
+    thread = Thread(target=fetchPage)
+    thread.daemon = True
+    thread.start()
+    return flight
 
+  # Fetches and decodes one page of iterRows
+  def fetchPage(self, url) :
     try:
-      # The mysterious 6.05 seconds on connect timeout is to prevent
-      # TCP from opening the connetion just as we give up
-      response = requests.get(url, timeout=(6.05, 22))
+      statusCode, page = SoQLInterface.transport.get(url)
+    except Exception as e:
+      raise SoQLError(str(e))
+    if (isinstance(page, dict)) :
+      raise SoQLError(page.get("message") or "query error")
+    if (statusCode < 200 or statusCode >= 300) :
+      raise SoQLError("error code %d"%statusCode)
+    return page
+
+  # Does the actual request for doGet, and caches the result
+  def fetch(self, url, cacheExpiration=None) :
+    # Whoever was fetching it before us may have just finished
+    if (url in SoQLInterface.cache) :
+      cacheEntry = SoQLInterface.cache.get(url)
+      if (cacheEntry) :
+        return cacheEntry
+
+    # An expired copy that came with validators is only fetched again if
+    # it has changed: otherwise it is good for another cacheExpiration
+    held = SoQLInterface.cache.peek(url)
+    validators = held[1] if held else None
+    try:
+      statusCode, allobjs, validators = SoQLInterface.transport.conditionalGet(url, validators)
     except requests.exceptions.Timeout:
       return [{'error_code' : 'timeout', 'try_again': True}]
     except Exception as e:
       return [{'error_code' : str(e), 'try_again': True}]
 
+    if (statusCode == 304) :
+      if (ISLEVEL(3)) : INFOPRINT("Not modified: URL %s"%url,3)
+      SoQLInterface.cache.put(url, held[0], ttlSeconds=cacheExpiration, validators=validators)
+      return held[0]
+
     # example error from SoDA
     #{
     #  "code" : "query.execution.queryTooComplex",
@@ -92,8 +216,7 @@ class SoQLInterface :
     #  }
     #}
 
-    allobjs = self.decoder.decode(response.content)
-    if (response.status_code < 200 or response.status_code >= 300) :
+    if (statusCode < 200 or statusCode >= 300) :
       if type(allobjs) is dict and allobjs.get("error") :
         return [{"error_code" : "query error"}]
     # Make sure we have a list if a singleton is returned
@@ -106,19 +229,24 @@ class SoQLInterface :
     for obj in allobjs:
       if (obj.get('error')) : dontCache = 1
     if dontCache == 0 :
-      SoQLInterface.cache.put(url, retval, ttlSeconds=cacheExpiration)
+      SoQLInterface.cache.put(url, retval, ttlSeconds=cacheExpiration, validators=validators)
     return retval
 
   # internal function that does a dual-purpose location or title search
+  # key may also be a tuple of keys, any of which may match (e.g. the
+  # three actor columns)
   def doSearch(self, key, value, antiKey, cacheExpiration=None) :
+    keys = key if isinstance(key, tuple) else (key,)
+    mirror = SoQLInterface.mirror
+    if (mirror is not None and mirror.loaded()) :
+      return mirror.search(keys, value, antiKey)
     resultList = self.doGet(
-                selectClause='locations, title, release_year',
-                whereClause=key+"='"+value+"'",
+                selectClause=SoQLInterface.searchColumns,
+                whereClause=" OR ".join(k+"='"+value+"'" for k in keys),
                 orderClause=antiKey,
                 cacheExpiration=cacheExpiration)
     return resultList
 
-
   # Public function that does a location search, returning all the
   # titles that filmed in this location
   # This can change quite frequently (people make movies in Fisherman's Wharf
@@ -129,7 +257,6 @@ class SoQLInterface :
     resultList = self.doSearch("locations", value, "title", cacheExpiration=86400)
     return resultList
 
-
   # Public function that does a title search, returning all the 
   # locations that this movie was filmed at. Movies don't suddenly change
   # locations, and thus the only change might be flaws in the data that were 
@@ -139,6 +266,128 @@ class SoQLInterface :
     resultList = self.doSearch("title", value, "locations")
     return resultList
 
+  # Public function that does an actor search, returning every filming
+  # location of every movie the actor was in. An actor can be listed in
+  # any of the three actor columns
+  def doActorSearch(self, value) :
+    resultList = self.doSearch(("actor_1", "actor_2", "actor_3"), value, "title")
+    return resultList
+
+
+  # Public function that does a director search, returning every filming
+  # location of every movie the director made
+  def doDirectorSearch(self, value) :
+    resultList = self.doSearch("director", value, "title")
+    return resultList
+
+
+#
+# The whole dataset, held locally, so that searches need not go to SODA.
+# There are only a few thousand rows, and they all come down in one
+# request anyway.
+#
+# Rows are held by column: every distinct string is kept once (in strings),
+# and each column is an array of string ids (-1 where the row has no
+# value). Each searchable column has a hash index of value to the ids of
+# the rows that have it.
+#
+# search answers what SoQLInterface.doSearch would have asked SODA for:
+# the rows where any of the key columns equals value exactly, as dicts of
+# locations, title and release_year (leaving out the missing ones, as
+# SODA does), in order of antiKey.
+#
+# load builds a whole new state and swaps it in in one assignment, so
+# searches in progress are never disturbed. It is up to the owner to call
+# it again when the dataset version changes (see AutocompleteRefresher)
+#
+class DatasetMirror(object) :
+
+  columns = ('title', 'locations', 'release_year', 'actor_1', 'actor_2', 'actor_3', 'director')
+  indexed = ('title', 'locations', 'actor_1', 'actor_2', 'actor_3', 'director')
+  resultColumns = ('locations', 'title', 'release_year')
+
+  def __init__(self) :
+    self.state = None
+    self.version = None
+
+  def loaded(self) :
+    return self.state is not None
+
+  # Fetches every row through si, page by page, and swaps them in.
+  # Returns False, leaving the mirror alone, if the fetch failed
+  def load(self, si, version=None) :
+    try:
+      state = DatasetMirror.buildState(si.iterRows(selectClause=",".join(DatasetMirror.columns)))
+    except SoQLError as e:
+      MUSTPRINT("Could not load dataset mirror: %s"%str(e))
+      return False
+    self.state = state
+    self.version = version
+    return True
+
+  @staticmethod
+  def buildState(rows) :
+    strings = list()
+    stringIds = dict()
+    columns = dict((column, array('i')) for column in DatasetMirror.columns)
+    indexes = dict((column, dict()) for column in DatasetMirror.indexed)
+    rowId = -1
+    for rowId, row in enumerate(rows) :
+      for column in DatasetMirror.columns :
+        value = row.get(column)
+        if (value is None) :
+          columns[column].append(-1)
+          continue
+        stringId = stringIds.get(value)
+        if (stringId is None) :
+          stringId = stringIds[value] = len(strings)
+          strings.append(value)
+        columns[column].append(stringId)
+        index = indexes.get(column)
+        if (index is not None) :
+          index.setdefault(value, array('i')).append(rowId)
+    return { 'rows' : rowId + 1, 'strings' : strings, 'columns' : columns, 'indexes' : indexes }
+
+  # The rows (dicts of resultColumns) with value in any of keys, in
+  # antiKey order, as doSearch would have them from SODA
+  def search(self, keys, value, antiKey) :
+    # The indexes are keyed on unicode (from the JSON): a UTF-8 str value
+    # would never match a non-ASCII title or location
+    if (isinstance(value, str)) :
+      value = value.decode("utf-8", "replace")
+    state = self.state
+    rowIds = set()
+    for key in keys :
+      rowIds.update(state['indexes'][key].get(value, ()))
+    strings = state['strings']
+    columns = state['columns']
+    order = columns[antiKey]
+    # In string order, missing values last (as SODA does), otherwise in
+    # dataset order
+    def orderKey(rowId) :
+      stringId = order[rowId]
+      if (stringId < 0) :
+        return (True, None, rowId)
+      return (False, strings[stringId], rowId)
+    retval = list()
+    for rowId in sorted(rowIds, key=orderKey) :
+      result = dict()
+      for column in DatasetMirror.resultColumns :
+        stringId = columns[column][rowId]
+        if (stringId >= 0) :
+          result[column] = strings[stringId]
+      retval.append(result)
+    return retval
+
+  def stats(self) :
+    state = self.state
+    if (state is None) :
+      return { 'loaded' : False }
+    return { 'loaded'  : True,
+             'version' : self.version,
+             'rows'    : state['rows'],
+             'strings' : len(state['strings']) }
+
 
 # This function COULD be made part of the SoQL class, but is made global 
 # to keep code short, and prevent a bunch of "SoQLInterface." all over 
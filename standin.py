@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Code Challenge for Mark Gerolimatos
+# (SF Movie Database)
+# mark@gerolimatos.com
+# 650 703-4774
+# (c) Mark Gerolimatos, save for code borrowed and credited
+#
+# October, 2014
+#
+from __future__ import print_function
+
+#
+# Local stand-ins for the services we talk to (SODA, the Google geocoder),
+# for benchmarks and checks that should not go out to the real ones, or
+# pay for them.
+#
+# StandInServer does the HTTP: each stand-in is a subclass that says what
+# to answer (respond), and nothing else.
+#
+
+from BaseImport import *
+from threading import Thread
+import json, gzip, StringIO, hashlib, urlparse
+import BaseHTTPServer, SocketServer
+from googleinterface import SFBounds
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler) :
+  # Without TCP_NODELAY, the headers and body (separate writes) would wait
+  # out a delayed ACK on a kept-open connection, which real servers do not
+  disable_nagle_algorithm = True
+
+  def setup(self) :
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.protocol_version = "HTTP/1.1" if self.server.keepAlive else "HTTP/1.0"
+
+  def do_GET(self) :
+    status, headers, content = self.server.respond(self)
+    self.send_response(status)
+    for name, value in headers :
+      self.send_header(name, value)
+    self.send_header("Content-Length", str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args) :
+    if (ISLEVEL(1)) : INFOPRINT(format%args, 1)
+
+
+#
+# A threaded HTTP server on localhost, on port (0 for any free one).
+# keepAlive keeps connections open between requests, as real servers do,
+# which matters for benchmarks; otherwise each one is closed after its
+# answer, so nothing is left waiting on a connection once the server stops.
+# Subclasses define respond(request), which returns (status code, list of
+# (header, value), body string) for a request (a StandInHandler: path,
+# headers)
+#
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer) :
+  daemon_threads = True
+
+  def __init__(self, port=0, keepAlive=False) :
+    self.keepAlive = keepAlive
+    BaseHTTPServer.HTTPServer.__init__(self, ("localhost", port), StandInHandler)
+
+  # Serves on a background thread. Returns self
+  def start(self) :
+    thread = Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def stop(self) :
+    self.shutdown()
+    self.server_close()
+
+  def port(self) :
+    return self.server_address[1]
+
+  def url(self, path="") :
+    return "http://localhost:%d%s"%(self.port(), path)
+
+  # A 200 answer of obj, as JSON
+  @staticmethod
+  def jsonResponse(obj) :
+    return 200, [("Content-Type", "application/json")], json.dumps(obj)
+
+  def respond(self, request) :
+    raise NotImplementedError
+
+
+#
+# Stand-in for a SODA server, for benchmarking: answers every GET with the
+# same JSON body (gzipped if asked), keeping the connection open. The body's
+# ETag is its MD5, and a request that already has it gets a 304.
+#
+class SodaStandIn(StandInServer) :
+
+  def __init__(self, body="[]", port=0) :
+    StandInServer.__init__(self, port, keepAlive=True)
+    self.body = body
+
+  def respond(self, request) :
+    content = self.body
+    etag = '"%s"'%hashlib.md5(content).hexdigest()
+    if (request.headers.get("If-None-Match") == etag) :
+      return 304, [("ETag", etag)], ""
+    headers = [("Content-Type", "application/json"), ("ETag", etag)]
+    if ("gzip" in request.headers.get("Accept-Encoding", "")) :
+      buf = StringIO.StringIO()
+      with gzip.GzipFile(fileobj=buf, mode="wb") as zipfile :
+        zipfile.write(content)
+      content = buf.getvalue()
+      headers.append(("Content-Encoding", "gzip"))
+    return 200, headers, content
+
+
+#
+# Stand-in for the SODA site, for checking the autocomplete refresher
+# without going to data.sfgov.org: the dataset metadata (anything under
+# /api/views/) says the dataset is at version, and the resource (anything
+# else) hands out rows, paged by $limit and $offset. Both may be changed
+# at any time.
+#
+class DatasetStandIn(StandInServer) :
+
+  def __init__(self, version="1", rows=(), port=0) :
+    StandInServer.__init__(self, port)
+    self.version = version
+    self.rows = list(rows)
+
+  def respond(self, request) :
+    url = urlparse.urlparse(request.path)
+    if (url.path.startswith("/api/views/")) :
+      return StandInServer.jsonResponse({ 'rowsUpdatedAt' : self.version })
+    query = urlparse.parse_qs(url.query)
+    offset = int(query.get('$offset', ["0"])[0])
+    limit = int(query.get('$limit', ["50000"])[0])
+    return StandInServer.jsonResponse(self.rows[offset:offset + limit])
+
+
+#
+# Stand-in for the Google geocoder, for trying the bulk geocoding job out
+# without paying for it. Answers like the real thing, with a made up point
+# in the city for each address (always the same one for the same address).
+# Addresses with "nowhere" in them are not found, and ones with "ambiguous"
+# in them get two results
+#
+class GeocodeStandIn(StandInServer) :
+
+  def respond(self, request) :
+    query = urlparse.parse_qs(urlparse.urlparse(request.path).query)
+    address = query.get('address', [""])[0].lower()
+    if ("nowhere" in address) :
+      return StandInServer.jsonResponse({ 'status' : "ZERO_RESULTS", 'results' : [] })
+    digest = hashlib.md5(address).digest()
+    lat = SFBounds.citySouth + (SFBounds.cityNorth - SFBounds.citySouth) * ord(digest[0]) / 256.0
+    lon = SFBounds.cityWest + (SFBounds.cityEast - SFBounds.cityWest) * ord(digest[1]) / 256.0
+    result = { 'formatted_address' : address,
+               'geometry' : { 'location' : { 'lat' : lat, 'lng' : lon } } }
+    count = 2 if "ambiguous" in address else 1
+    return StandInServer.jsonResponse({ 'status' : "OK", 'results' : [result] * count })